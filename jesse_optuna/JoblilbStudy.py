@@ -1,55 +1,278 @@
+import abc
+import concurrent.futures
 import copy
+import multiprocessing
+import time
 
 import optuna
 import joblib
 import numpy as np
-import psutil, gc
+import gc
 
+from .storages import release_study
+from .worker_pool import WorkerError, count_trial, get_retire_reason, retire
 
-ps = psutil.Process()
-def memory_usage_psutil():
+
+class _Budget(abc.ABC):
+    """
+    job slots of a WorkerPool beyond its active_workers don't take trials
+    """
+    def __init__(self, timeout=None, active_workers=None):
+        self.deadline = None if timeout is None else time.time() + timeout
+        self._active_workers = active_workers
+
+    def slot_active(self, slot) -> bool:
+        return self._active_workers is None or slot is None or slot < self._active_workers.value
+
+    def wait_for_slot(self, slot) -> bool:
+        """
+        blocks while the slot is inactive. False once the budget or the time is used up.
+        """
+        while not self.slot_active(slot):
+            if self._exhausted() or (self.deadline is not None and time.time() >= self.deadline):
+                return False
+            time.sleep(1)
+        return True
+
+    def next_trial(self, slot):
+        """
+        counts the finished trial and claims the next trial unless this worker has to
+        be replaced first. Returns the claim or None if the worker retires.
+        """
+        if count_trial() is not None:
+            return None
+        if not self.slot_active(slot):
+            retire('slot paused')
+            return None
+        return self.claim()
+
+    @abc.abstractmethod
+    def _exhausted(self) -> bool:
+        """
+        True once every trial of the budget was claimed
+        """
+
+    @abc.abstractmethod
+    def claim(self):
+        """
+        claims the next trial, see the subclasses for what is returned
+        """
+
+
+class TrialBudget(_Budget):
+    """
+    global trial budget shared by all workers. Trials are handed out one at a time
+    until n_trials are used up or the timeout is reached, so fast workers simply
+    take more trials instead of idling.
+    """
+    def __init__(self, manager, n_trials=None, timeout=None, active_workers=None):
+        super().__init__(timeout, active_workers)
+        # -1 means unlimited
+        self._remaining = manager.Value('i', -1 if n_trials is None else n_trials)
+        self._lock = manager.Lock()
+
+    def _exhausted(self) -> bool:
+        return self._remaining.value == 0
+
+    def claim(self) -> bool:
+        if self.deadline is not None and time.time() >= self.deadline:
+            return False
+        with self._lock:
+            if self._remaining.value == 0:
+                return False
+            if self._remaining.value > 0:
+                self._remaining.value -= 1
+        return True
+
+
+class MultiTrialBudget(_Budget):
+    """
+    trial budgets of several studies sharing the same workers. Every claim goes to
+    the study with the most trials left, so the cores are shared weighted by the
+    remaining work and no worker idles while any study still has trials.
+    """
+    def __init__(self, manager, n_trials, timeout=None, active_workers=None):
+        super().__init__(timeout, active_workers)
+        # -1 means unlimited
+        self._remaining = manager.list([-1 if n is None else n for n in n_trials])
+        self._lock = manager.Lock()
+
+    def _exhausted(self) -> bool:
+        return all(n == 0 for n in list(self._remaining))
+
+    def claim(self):
+        """
+        returns the index of the study to run the next trial of or None if all budgets are used up
+        """
+        if self.deadline is not None and time.time() >= self.deadline:
+            return None
+        with self._lock:
+            remaining = list(self._remaining)
+            candidates = [i for i, n in enumerate(remaining) if n != 0]
+            if not candidates:
+                return None
+            index = max(candidates, key=lambda i: float('inf') if remaining[i] < 0 else remaining[i])
+            if remaining[index] > 0:
+                self._remaining[index] = remaining[index] - 1
+        return index
+
+
+def _optimize_studies(studies, funcs, budget, on_worker_done=None, slot=None, **optimize_parameters):
+    loaded = {}
+    if not budget.wait_for_slot(slot):
+        return None
+    try:
+        index = budget.claim()
+        while index is not None:
+            if index not in loaded:
+                loaded[index] = studies[index]._load_study()
+            loaded[index].optimize(funcs[index], n_trials=1, **optimize_parameters, catch=(Exception,))
+            index = budget.next_trial(slot)
+    finally:
+        if on_worker_done is not None:
+            on_worker_done()
+        for study in loaded.values():
+            release_study(study)
+    del loaded
     gc.collect()
-    mem = ps.memory_percent()
-    return mem
+    return get_retire_reason()
+
+
+# consecutive failed jobs (e.g. killed workers) after which _run_jobs gives a slot up
+_MAX_JOB_FAILURES = 3
+
+
+def _run_jobs(pool, submit_job, n_jobs: int) -> None:
+    """
+    runs n_jobs jobs on the pool, submit_job(slot) submits the job of a slot. The job of
+    a slot whose worker retired or died (see WorkerPool) is submitted again to continue
+    on a fresh worker, it stops by itself once the budget is used up. A slot whose job
+    fails _MAX_JOB_FAILURES times in a row is given up; once the other slots are done
+    the last error of a given up slot is raised.
+    """
+    futures = {submit_job(slot): slot for slot in range(n_jobs)}
+    failures = dict.fromkeys(range(n_jobs), 0)
+    given_up = None
+    while futures:
+        done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            slot = futures.pop(future)
+            try:
+                reason = future.result()
+            except WorkerError as err:
+                failures[slot] += 1
+                lines = str(err).strip().splitlines()
+                pool.record_event('job_failed', slot=slot, error=lines[-1] if lines else repr(err))
+                if failures[slot] < _MAX_JOB_FAILURES:
+                    futures[submit_job(slot)] = slot
+                else:
+                    pool.record_event('slot_given_up', slot=slot)
+                    given_up = err
+                continue
+            failures[slot] = 0
+            if reason is not None:
+                pool.record_event('worker_recycled', slot=slot, reason=reason)
+                futures[submit_job(slot)] = slot
+    if given_up is not None:
+        raise given_up
+
+
+def _record_events(studies, events) -> None:
+    if events:
+        for study in studies:
+            study.set_user_attr('resource_events', events[-100:])
+
+
+def optimize_concurrently(studies, funcs, n_trials, pool, n_jobs=-1, timeout=None, on_worker_done=None,
+                          **optimize_parameters):
+    """
+    optimizes several JoblibStudies at once on the workers of a WorkerPool. Each worker
+    takes its next trial from the study with the most trials left until all budgets
+    (or the shared timeout) are used up. on_worker_done is called in every worker
+    after its last trial.
+    """
+    if n_jobs == -1:
+        n_jobs = pool.n_workers
+    budget = MultiTrialBudget(pool.manager, n_trials, timeout, pool.active_workers)
+    first_event = len(pool.events)
+    try:
+        _run_jobs(pool, lambda slot: pool.submit(_optimize_studies, studies, funcs, budget, on_worker_done, slot,
+                                                 **optimize_parameters), min(n_jobs, pool.n_workers))
+    finally:
+        _record_events(studies, pool.events[first_event:])
+
 
 class JoblibStudy:
     def __init__(self, **study_parameters):
         self.study_parameters = study_parameters
         self.study: optuna.study.Study = optuna.create_study(**study_parameters)
 
-    def _optimize_study(self, func, n_trials, **optimize_parameters):
+    def _load_study(self):
         study_parameters = copy.copy(self.study_parameters)
         study_parameters["study_name"] = self.study.study_name
         study_parameters["load_if_exists"] = True
         study = optuna.create_study(**study_parameters)
         study.sampler.reseed_rng()
-        study.optimize(func, n_trials=n_trials, **optimize_parameters, catch=(Exception,))
-        del study
-        gc.collect()
+        return study
+
+    def _optimize_study(self, func, budget, on_worker_done=None, slot=None, **optimize_parameters):
+        """
+        runs trials until the budget is used up. Returns why the worker has to be
+        replaced or None.
+        """
+        if not budget.wait_for_slot(slot) or not budget.claim():
+            return None
 
+        study = self._load_study()
 
-    @staticmethod
-    def _split_trials(n_trials, n_jobs):
-        n_per_job, remaining = divmod(n_trials, n_jobs)
-        for _ in range(n_jobs):
-            yield n_per_job + (1 if remaining > 0 else 0)
-            remaining -= 1
+        def claim_next_trial(study, trial):
+            if not budget.next_trial(slot):
+                study.stop()
+
+        callbacks = list(optimize_parameters.pop("callbacks", None) or []) + [claim_next_trial]
+        try:
+            study.optimize(func, n_trials=None, callbacks=callbacks, **optimize_parameters, catch=(Exception,))
+        finally:
+            if on_worker_done is not None:
+                on_worker_done()
+            release_study(study)
+        del study
+        gc.collect()
+        return get_retire_reason()
 
-    def optimize(self, func, n_trials=1, n_jobs=-1, **optimize_parameters):
+    def optimize(self, func, n_trials=1, n_jobs=-1, timeout=None, pool=None, on_worker_done=None,
+                 **optimize_parameters):
+        """
+        runs the trials on n_jobs joblib workers or, if a WorkerPool is given, on its
+        long lived workers that keep their imports and caches between studies.
+        on_worker_done is called in every worker after its last trial.
+        """
         if n_jobs == -1:
-            n_jobs = joblib.cpu_count()
+            n_jobs = pool.n_workers if pool is not None else joblib.cpu_count()
 
-        if n_jobs == 1:
-            self.study.optimize(func, n_trials=n_trials, **optimize_parameters)
+        if n_jobs == 1 and pool is None:
+            try:
+                self.study.optimize(func, n_trials=n_trials, timeout=timeout, **optimize_parameters)
+            finally:
+                if on_worker_done is not None:
+                    on_worker_done()
+        elif pool is not None:
+            budget = TrialBudget(pool.manager, n_trials, timeout, pool.active_workers)
+            first_event = len(pool.events)
+            try:
+                _run_jobs(pool, lambda slot: pool.submit(self._optimize_study, func, budget, on_worker_done, slot,
+                                                         **optimize_parameters), min(n_jobs, pool.n_workers))
+            finally:
+                _record_events([self], pool.events[first_event:])
         else:
-            parallel = joblib.Parallel(n_jobs, verbose=10, max_nbytes=None)
-            parallel(
-                joblib.delayed(self._optimize_study)(func, n_trials=n_trials_i, **optimize_parameters)
-                for n_trials_i in self._split_trials(n_trials, n_jobs)
-            )
-            print('have parallel list', memory_usage_psutil())
+            with multiprocessing.Manager() as manager:
+                budget = TrialBudget(manager, n_trials, timeout)
+                parallel = joblib.Parallel(n_jobs, verbose=10, max_nbytes=None)
+                parallel(
+                    joblib.delayed(self._optimize_study)(func, budget, on_worker_done, **optimize_parameters)
+                    for _ in range(n_jobs)
+                )
             del parallel
-            print('delete parallel list', memory_usage_psutil())
             gc.collect()
 
     def set_user_attr(self, key: str, value):
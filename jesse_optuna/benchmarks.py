@@ -0,0 +1,284 @@
+import sys
+import time
+
+import click
+
+# json, statistics and subprocess are imported by the commands, the cli imports this module on every start
+
+# modules a plain `import jesse_optuna` (cli start-up and every worker) must not load
+HEAVY_MODULES = ('jesse', 'optuna', 'pandas', 'numpy', 'matplotlib', 'psutil', 'pyarrow', 'sqlalchemy')
+
+
+def _time_command(code: str, runs: int) -> list:
+    import subprocess
+
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], check=True, stdout=subprocess.DEVNULL)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def _slowest_imports(code: str, count: int = 5) -> list:
+    """
+    the modules with the largest cumulative import time according to python -X importtime
+    """
+    import subprocess
+
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], check=True,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line[len('import time:'):].split('|')
+        imports.append((int(cumulative) / 1000, module.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+@click.group()
+def benchmark() -> None:
+    """
+    performance checks, they exit with code 1 on a regression
+    """
+    pass
+
+
+@benchmark.command(name='import')
+@click.option('--runs', default=10, show_default=True, help='number of measured start-ups')
+@click.option('--max-ms', default=300.0, show_default=True,
+              help='fail if the median start-up of `jesse-optuna --version` takes longer')
+def import_time(runs: int, max_ms: float) -> None:
+    """
+    measures the start-up of the cli and checks that importing the package loads no heavy modules
+    """
+    import json
+    import statistics
+    import subprocess
+
+    loaded = json.loads(subprocess.run(
+        [sys.executable, '-c', f'import json, sys, jesse_optuna; '
+                               f'print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))'],
+        check=True, stdout=subprocess.PIPE, text=True).stdout)
+
+    interpreter = _time_command('pass', runs)
+    package = _time_command('import jesse_optuna', runs)
+    version = _time_command("from jesse_optuna import cli; cli(['--version'])", runs)
+
+    print(f"python start-up           median {statistics.median(interpreter):7.1f} ms  min {min(interpreter):7.1f} ms")
+    print(f"import jesse_optuna       median {statistics.median(package):7.1f} ms  min {min(package):7.1f} ms")
+    print(f"jesse-optuna --version    median {statistics.median(version):7.1f} ms  min {min(version):7.1f} ms")
+    print("slowest imports of jesse-optuna --version:")
+    for cumulative, module in _slowest_imports("from jesse_optuna import cli; cli(['--version'])"):
+        print(f"  {cumulative:7.1f} ms  {module}")
+
+    failed = False
+    if loaded:
+        print(f"FAIL: import jesse_optuna loads {', '.join(loaded)}")
+        failed = True
+    if statistics.median(version) > max_ms:
+        print(f"FAIL: jesse-optuna --version takes {statistics.median(version):.1f} ms, more than {max_ms} ms")
+        failed = True
+    if failed:
+        sys.exit(1)
+    print("OK")
+
+
+def _gc_run(policy: str, trials: int) -> None:
+    """
+    runs trials of the project's strategy in this process under one gc policy and prints
+    trials/sec, peak rss and the rss growth after warm-up as json
+    """
+    import functools
+    import json
+    import os
+
+    import optuna
+    import psutil
+
+    from .config import get_config, update_config
+    from .gc_policy import GcPolicy
+    from .optimization import objective
+
+    cfg = get_config()
+    # every trial has to run a backtest and nothing may be pruned
+    cfg.update(study_name='benchmark', memoize=False, pruner='NopPruner', gc_policy=policy)
+    run_config_path = 'storage/jesse-optuna/run/benchmark.yml'
+    os.makedirs(os.path.dirname(run_config_path), exist_ok=True)
+    os.makedirs('storage/jesse-optuna/csv', exist_ok=True)
+    update_config(cfg, run_config_path)
+
+    process = psutil.Process()
+    rss = []
+
+    def measure(study, trial) -> None:
+        rss.append(process.memory_info().rss / 1024 / 1024)
+
+    optuna.logging.set_verbosity(optuna.logging.WARNING)
+    study = optuna.create_study(direction='maximize', sampler=optuna.samplers.RandomSampler(seed=0))
+    start = time.perf_counter()
+    study.optimize(functools.partial(objective, run_config_path=run_config_path), n_trials=trials,
+                   callbacks=[GcPolicy(policy, cfg.get('gc_every_n') or 100, cfg.get('gc_thresholds')), measure])
+    duration = time.perf_counter() - start
+
+    warm = rss[max(len(rss) // 5 - 1, 0)]
+    print(json.dumps({'trials_per_s': trials / duration, 'peak_rss_mb': max(rss), 'growth_mb': rss[-1] - warm}))
+
+
+@benchmark.command(name='gc')
+@click.option('--trials', default=200, show_default=True, help='trials per policy')
+@click.option('--policies', default='collect,threshold,every_n,recycle', show_default=True)
+@click.option('--max-growth-mb', default=50.0, show_default=True,
+              help='policies whose rss grows more after warm-up are not recommended')
+def gc_policies(trials: int, policies: str, max_growth_mb: float) -> None:
+    """
+    compares the gc policies on the strategy of optuna_config.yml, every policy runs in a fresh process
+    """
+    import json
+    import subprocess
+
+    from .config import validate_cwd
+
+    validate_cwd()
+    results = {}
+    for policy in policies.split(','):
+        output = subprocess.run(
+            [sys.executable, '-c', f'from jesse_optuna.benchmarks import _gc_run; _gc_run({policy!r}, {trials})'],
+            check=True, stdout=subprocess.PIPE, text=True).stdout
+        results[policy] = json.loads(output.strip().splitlines()[-1])
+
+    print(f"{'policy':<10} {'trials/s':>9} {'peak rss':>10} {'growth':>10}")
+    for policy, result in results.items():
+        print(f"{policy:<10} {result['trials_per_s']:9.2f} {result['peak_rss_mb']:7.1f} MB "
+              f"{result['growth_mb']:7.1f} MB")
+    # recycle runs without any collection in one process, its growth is what recycle_after_growth_mb has to catch
+    bounded = [policy for policy in results if results[policy]['growth_mb'] <= max_growth_mb]
+    if not bounded:
+        print(f"FAIL: the rss of every policy grows more than {max_growth_mb} MB")
+        sys.exit(1)
+    best = max(bounded, key=lambda policy: results[policy]['trials_per_s'])
+    print(f"recommended gc_policy: {best}")
+
+
+@benchmark.command(name='trial-attrs')
+@click.option('--storage', default='sqlite:///storage/jesse-optuna/benchmark.sqlite', show_default=True,
+              help='storage url, e.g. a local postgres database created with create-db')
+@click.option('--trials', default=200, show_default=True, help='trials per write mode')
+def trial_attrs(storage: str, trials: int) -> None:
+    """
+    compares one set_user_attr per metric with the single metrics attr written by objective()
+    """
+    import os
+
+    import optuna
+
+    from .result_sink import empty_backtest_data
+
+    if storage.startswith('sqlite:///'):
+        os.makedirs(os.path.dirname(storage[len('sqlite:///'):]) or '.', exist_ok=True)
+    optuna.logging.set_verbosity(optuna.logging.WARNING)
+    metrics = {f'{prefix}-{key}': 1.5 for prefix in ('training', 'testing') for key in empty_backtest_data}
+
+    def per_key(trial) -> None:
+        for key, value in metrics.items():
+            trial.set_user_attr(key, value)
+
+    def single(trial) -> None:
+        trial.set_user_attr('metrics', metrics)
+
+    timings = {}
+    for mode, write in (('per key', per_key), ('single', single)):
+        study_name = f'benchmark-trial-attrs-{mode.replace(" ", "-")}'
+        try:
+            optuna.delete_study(study_name=study_name, storage=storage)
+        except KeyError:
+            pass
+        study = optuna.create_study(study_name=study_name, storage=storage)
+        start = time.perf_counter()
+        for _ in range(trials):
+            trial = study.ask()
+            write(trial)
+            study.tell(trial, 0)
+        timings[mode] = time.perf_counter() - start
+        optuna.delete_study(study_name=study_name, storage=storage)
+
+    for mode, duration in timings.items():
+        print(f"{mode:<8} {trials / duration:8.1f} trials/s  {duration / trials * 1000:7.2f} ms per trial")
+    print(f"{len(metrics)} metrics, the single attr is {timings['per key'] / timings['single']:.1f}x faster")
+
+
+def _storage_objective(trial) -> float:
+    return trial.suggest_float('x', -10, 10) ** 2 + trial.suggest_int('y', 0, 10)
+
+
+def _storage_worker(storage_cfg: dict, study_name: str, n_trials: int) -> tuple:
+    """
+    one worker of the storage benchmark, returns when it started and finished its trials
+    and the sql statements it sent
+    """
+    import optuna
+
+    from .storages import get_round_trips, get_storage
+
+    optuna.logging.set_verbosity(optuna.logging.WARNING)
+    # TPE reads the whole trial history for every trial, like the samplers of a real study
+    study = optuna.load_study(study_name=study_name, storage=get_storage(storage_cfg),
+                              sampler=optuna.samplers.TPESampler(n_startup_trials=10))
+    start = time.time()
+    study.optimize(_storage_objective, n_trials=n_trials)
+    return start, time.time(), get_round_trips()[0]
+
+
+@benchmark.command(name='storage')
+@click.option('--backends', default='sqlite,journal', show_default=True,
+              help='postgres uses the database of optuna_config.yml')
+@click.option('--workers', default='1,4,10,32', show_default=True, help='numbers of worker processes')
+@click.option('--trials', default=320, show_default=True, help='trials of every run, split between the workers')
+def storage_throughput(backends: str, workers: str, trials: int) -> None:
+    """
+    trials/sec of the optuna storages with several worker processes writing to one study
+    """
+    import concurrent.futures
+    import multiprocessing
+    import tempfile
+
+    import optuna
+
+    from .config import get_config
+    from .storages import get_storage
+
+    optuna.logging.set_verbosity(optuna.logging.WARNING)
+    worker_counts = [int(n) for n in workers.split(',')]
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for backend in backends.split(','):
+            for n_workers in worker_counts:
+                storage_cfg = {'storage': backend}
+                if backend == 'postgres':
+                    storage_cfg.update(get_config(), storage='postgres', storage_pool_size=1, storage_max_overflow=0)
+                else:
+                    # a fresh file for every run
+                    storage_cfg['storage_path'] = f'{directory}/{backend}-{n_workers}'
+                storage = get_storage(storage_cfg)
+                study_name = f'benchmark-storage-{n_workers}'
+                try:
+                    optuna.delete_study(study_name=study_name, storage=storage)
+                except KeyError:
+                    pass
+                optuna.create_study(study_name=study_name, storage=storage)
+
+                with concurrent.futures.ProcessPoolExecutor(n_workers,
+                                                            mp_context=multiprocessing.get_context('spawn')) as pool:
+                    spans = list(pool.map(_storage_worker, [storage_cfg] * n_workers, [study_name] * n_workers,
+                                          [trials // n_workers + (i < trials % n_workers) for i in range(n_workers)]))
+                results[backend, n_workers] = trials / (max(span[1] for span in spans) - min(span[0] for span in spans))
+                round_trips = sum(span[2] for span in spans) / trials
+                if backend == 'postgres':
+                    optuna.delete_study(study_name=study_name, storage=storage)
+                print(f"{backend:<10} {n_workers:3d} workers {results[backend, n_workers]:8.1f} trials/s"
+                      + (f" {round_trips:6.1f} round-trips/trial" if backend != 'journal' else ''))
+
+    for n_workers in worker_counts:
+        best = max((b for b, n in results if n == n_workers), key=lambda b: results[b, n_workers])
+        print(f"fastest with {n_workers} workers: {best}")
@@ -0,0 +1,213 @@
+import json
+import os
+import pathlib
+import pickle
+import re
+import tempfile
+
+import jesse.helpers as jh
+import numpy as np
+from jesse.research import get_candles
+
+from .file_lock import file_lock
+
+CACHE_DIR = pathlib.Path('storage/jesse-optuna')
+NPY_DIR = CACHE_DIR / 'candles'
+
+_LEGACY_RANGE = re.compile(r'-1m-(\d{4}-\d{2}-\d{2})-(\d{4}-\d{2}-\d{2})\.(pickle|npy)$')
+
+# superset file -> (covered start timestamp, covered finish timestamp, memory mapped candles) of this process
+_mapped = {}
+# (exchange, symbol, start date, finish date) -> (memory mapped superset, fingerprint) of this process
+_fingerprints = {}
+
+
+def get_candles_with_cache(exchange: str, symbol: str, start_date: str, finish_date: str,
+                           max_cache_size_mb=None) -> np.ndarray:
+    """
+    returns the 1m candles from start_date until (excluding) finish_date as a view
+    into one cached superset per exchange and symbol. The superset is a copy-on-write
+    memory map of a .npy file, so all workers share the same page cache pages and
+    every window (train, testing, charts) is a slice without any copy.
+    """
+    start = jh.date_to_timestamp(start_date)
+    finish = jh.date_to_timestamp(finish_date)
+
+    cache_file = NPY_DIR / f"{exchange}-{symbol}-1m.npy"
+    cached = _mapped.get(cache_file)
+    if cached is None or start < cached[0] or finish > cached[1]:
+        cached = _load_superset(cache_file, exchange, symbol, start, finish, max_cache_size_mb)
+        _mapped[cache_file] = cached
+
+    candles = cached[2]
+    timestamps = candles[:, 0]
+    return candles[np.searchsorted(timestamps, start):np.searchsorted(timestamps, finish)]
+
+
+def get_candles_checksum(candles: np.ndarray) -> str:
+    """
+    cheap checksum of the candles, the sum of their closes
+    """
+    return repr(float(candles[:, 2].sum()))
+
+
+def get_candles_fingerprint(exchange: str, symbol: str, start_date: str, finish_date: str,
+                            max_cache_size_mb=None) -> str:
+    """
+    identifies the candles of a window by their count, last timestamp and a checksum of
+    the closes. It changes when the candles are imported again or gaps are filled.
+    """
+    candles = get_candles_with_cache(exchange, symbol, start_date, finish_date, max_cache_size_mb)
+    superset = _mapped[NPY_DIR / f"{exchange}-{symbol}-1m.npy"][2]
+    key = (exchange, symbol, start_date, finish_date)
+    cached = _fingerprints.get(key)
+    if cached is not None and cached[0] is superset:
+        return cached[1]
+
+    last = int(candles[-1, 0]) if len(candles) else 0
+    fingerprint = f'{len(candles)}:{last}:{get_candles_checksum(candles)}'
+    _fingerprints[key] = (superset, fingerprint)
+    return fingerprint
+
+
+def _load_superset(cache_file: pathlib.Path, exchange: str, symbol: str, start: int, finish: int,
+                   max_cache_size_mb):
+    NPY_DIR.mkdir(parents=True, exist_ok=True)
+    meta_file = cache_file.with_suffix('.json')
+
+    # only one worker at a time may grow the superset of a symbol
+    with file_lock(cache_file.with_suffix('.lock')):
+        if cache_file.is_file() and meta_file.is_file():
+            with open(meta_file, 'r') as handle:
+                meta = json.load(handle)
+            covered_start, covered_finish = meta['start'], meta['finish']
+            if start < covered_start or finish > covered_finish:
+                candles = np.load(cache_file)
+                parts = []
+                if start < covered_start:
+                    parts.append(_fetch(exchange, symbol, start, covered_start))
+                parts.append(candles)
+                if finish > covered_finish:
+                    parts.append(_fetch(exchange, symbol, covered_finish, finish))
+                covered_start, covered_finish = min(start, covered_start), max(finish, covered_finish)
+                _save(cache_file, meta_file, np.concatenate(parts), covered_start, covered_finish)
+                evicted = max_cache_size_mb is not None
+            else:
+                # mark as recently used for the LRU eviction
+                os.utime(cache_file)
+                evicted = False
+        else:
+            candles, covered_start, covered_finish = _migrate_legacy_cache(exchange, symbol, start, finish)
+            if candles is None:
+                candles, covered_start, covered_finish = _fetch(exchange, symbol, start, finish), start, finish
+            _save(cache_file, meta_file, candles, covered_start, covered_finish)
+            evicted = max_cache_size_mb is not None
+
+        # jesse fixes jumped candles in place, so the map has to be copy-on-write
+        # instead of read-only. Untouched pages stay shared between the workers.
+        candles = np.load(cache_file, mmap_mode='c')
+
+    if evicted:
+        evict_candle_cache(max_cache_size_mb, keep=cache_file)
+
+    return covered_start, covered_finish, candles
+
+
+def _fetch(exchange: str, symbol: str, start: int, finish: int) -> np.ndarray:
+    return get_candles(exchange, symbol, '1m', jh.timestamp_to_date(start), jh.timestamp_to_date(finish))
+
+
+def _fix_jumped_candles(candles: np.ndarray) -> np.ndarray:
+    """
+    applies jesse's jumped candle fix once for the whole superset. Every window then
+    sees the same candles no matter where it starts and jesse's in place fix is a no-op.
+    """
+    if len(candles) < 2:
+        return candles
+    previous_close = candles[:-1, 2]
+    opens = candles[1:, 1]
+    candles[1:, 4] = np.where(previous_close < opens, np.minimum(previous_close, candles[1:, 4]), candles[1:, 4])
+    candles[1:, 3] = np.where(previous_close > opens, np.maximum(previous_close, candles[1:, 3]), candles[1:, 3])
+    candles[1:, 1] = previous_close
+    return candles
+
+
+def _save(cache_file: pathlib.Path, meta_file: pathlib.Path, candles: np.ndarray, start: int, finish: int) -> None:
+    candles = _fix_jumped_candles(np.array(candles, dtype=np.float64))
+    # write to temporary files first so other workers never map a half written file
+    fd, tmp_path = tempfile.mkstemp(dir=cache_file.parent, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as handle:
+            np.save(handle, candles)
+        os.replace(tmp_path, cache_file)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    fd, tmp_path = tempfile.mkstemp(dir=meta_file.parent, suffix='.tmp')
+    with os.fdopen(fd, 'w') as handle:
+        json.dump({'start': start, 'finish': finish}, handle)
+    os.replace(tmp_path, meta_file)
+
+
+def _migrate_legacy_cache(exchange: str, symbol: str, start: int, finish: int):
+    """
+    seeds the superset with the widest old per-range cache file (pickle or .npy) that
+    covers the requested window and removes all old cache files of the symbol.
+    """
+    prefix = f"{exchange}-{symbol}-1m-"
+    legacy_files = [f for f in list(CACHE_DIR.glob('*.pickle')) + list(NPY_DIR.glob('*.npy'))
+                    if f.name.startswith(prefix) and _LEGACY_RANGE.match(f.name[len(prefix) - 4:])]
+
+    best = None
+    for f in legacy_files:
+        match = _LEGACY_RANGE.match(f.name[len(prefix) - 4:])
+        file_start, file_finish = jh.date_to_timestamp(match.group(1)), jh.date_to_timestamp(match.group(2))
+        if file_start <= start and file_finish >= finish and (
+                best is None or file_finish - file_start > best[2] - best[1]):
+            best = (f, file_start, file_finish)
+
+    candles = None
+    if best is not None:
+        if best[0].suffix == '.pickle':
+            with open(best[0], 'rb') as handle:
+                candles = pickle.load(handle)
+        else:
+            candles = np.load(best[0])
+
+    for f in legacy_files:
+        f.unlink()
+
+    if candles is None:
+        return None, None, None
+    return candles, best[1], best[2]
+
+
+def evict_candle_cache(max_cache_size_mb: float, keep=None) -> None:
+    """
+    deletes the least recently used supersets until the cache fits into max_cache_size_mb.
+    Already mapped files stay valid for the processes using them.
+    """
+    files = []
+    for f in NPY_DIR.glob('*.npy'):
+        try:
+            stat = f.stat()
+        except FileNotFoundError:
+            # evicted by another worker in the meantime
+            continue
+        files.append((stat.st_mtime, stat.st_size, f))
+    total_size = sum(size for _, size, _ in files)
+    max_size = max_cache_size_mb * 1024 * 1024
+
+    for _, size, f in sorted(files, key=lambda x: x[0]):
+        if total_size <= max_size:
+            break
+        if f == keep:
+            continue
+        with file_lock(f.with_suffix('.lock')):
+            for path in (f, f.with_suffix('.json')):
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+        _mapped.pop(f, None)
+        total_size -= size
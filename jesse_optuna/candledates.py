@@ -1,19 +1,44 @@
+import json
+import os
+import pathlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
 import arrow
 import numpy as np
+from peewee import Case, fn
 
 import jesse.helpers as jh
 from jesse.config import config
-from jesse.exceptions import CandleNotFoundInDatabase
 from jesse.models import Candle
-from jesse.services.cache import cache
-from jesse.services.candle import generate_candle_from_one_minutes
+from jesse.research import import_candles
+from jesse.services import required_candles
 from jesse.store import store
 
+from .candle_cache import get_candles_checksum
+from .file_lock import file_lock
+
+COVERAGE_INDEX_PATH = pathlib.Path('storage/jesse-optuna/candle_coverage.json')
+WARMUP_DIR = pathlib.Path('storage/jesse-optuna/warmup')
+# oldest store snapshots are deleted above this count
+WARMUP_MAX_FILES = 4096
+
+# jesse's own warm-up injection, used for storages _fill_storage can't write
+_jesse_inject_required_candles_to_store = required_candles.inject_required_candles_to_store
+
+
+def get_first_and_last_date(exchange: str, symbol: str, start_date_str: str, finish_date_str: str):
+    """
+    checks if the warm-up candles required before executing strategies exist.
+    210 for the biggest timeframe and more for the rest.
+    returns (success, first backtestable date, last date, message)
+    """
+    return get_first_and_last_dates(exchange, [symbol], start_date_str, finish_date_str)[symbol]
+
 
-def get_first_and_last_date(exchange: str, symbol: str, start_date_str: str, finish_date_str: str) -> np.ndarray:
+def _get_warmup_range(start_date_str: str, finish_date_str: str):
     """
-    loads initial candles that required before executing strategies.
-    210 for the biggest timeframe and more for the rest
+    returns the first and last timestamp of the warm-up candles and their count
     """
     start_date = jh.arrow_to_timestamp(arrow.get(start_date_str, 'YYYY-MM-DD'))
     finish_date = jh.arrow_to_timestamp(arrow.get(finish_date_str, 'YYYY-MM-DD')) - 60000
@@ -35,103 +60,301 @@ def get_first_and_last_date(exchange: str, symbol: str, start_date_str: str, fin
     # update candles_count to count from the beginning of the day instead
     short_candles_count = int((pre_finish_date - pre_start_date) / 60_000)
 
-    key = jh.key(exchange, symbol)
-    cache_key = f'{jh.timestamp_to_date(pre_start_date)}-{jh.timestamp_to_date(pre_finish_date)}-{key}'
-    cached_value = cache.get_value(cache_key)
-
-    # if cache exists
-    if cached_value:
-        candles_tuple = cached_value
-    # not cached, get and cache for later calls in the next 5 minutes
-    else:
-        # fetch from database
-        candles_tuple = tuple(
-            Candle.select(
-                Candle.timestamp, Candle.open, Candle.close, Candle.high, Candle.low,
-                Candle.volume
-            ).where(
-                Candle.timestamp.between(pre_start_date, pre_finish_date),
-                Candle.exchange == exchange,
-                Candle.symbol == symbol
-            ).order_by(Candle.timestamp.asc()).tuples()
-        )
-
-        # cache it for near future calls
-        cache.set_value(cache_key, candles_tuple, expire_seconds=60 * 60 * 24 * 7)
-
-    candles = np.array(candles_tuple)
-
-    if len(candles) < short_candles_count + 1:
-        first_existing_candle = tuple(
-            Candle.select(Candle.timestamp).where(
-                Candle.exchange == exchange,
-                Candle.symbol == symbol
-            ).order_by(Candle.timestamp.asc()).limit(1).tuples()
-        )
-
-        if not len(first_existing_candle):
-            return False, None, None, f'No candle for {exchange} {symbol} is present in the database. Try importing candles.'
-            raise CandleNotFoundInDatabase(
-                f'No candle for {exchange} {symbol} is present in the database. Try importing candles.'
-            )
-
-        first_existing_candle = first_existing_candle[0][0]
-
-        last_existing_candle = tuple(
-            Candle.select(Candle.timestamp).where(
-                Candle.exchange == exchange,
-                Candle.symbol == symbol
-            ).order_by(Candle.timestamp.desc()).limit(1).tuples()
-        )[0][0]
-
-        first_backtestable_timestamp = first_existing_candle + (pre_finish_date - pre_start_date) + (60_000 * 1440)
-
-        # if first backtestable timestamp is in the future, that means we have some but not enough candles
-        if first_backtestable_timestamp > jh.today_to_timestamp():
-            return False, jh.timestamp_to_date(first_backtestable_timestamp), jh.timestamp_to_date(last_existing_candle), f'Not enough candle for {exchange} {symbol} is present in the database. Jesse requires "210 * biggest_timeframe" warm-up candles. Try importing more candles from an earlier date.'
-            raise CandleNotFoundInDatabase(
-                f'Not enough candle for {exchange} {symbol} is present in the database. Jesse requires "210 * biggest_timeframe" warm-up candles. '
-                'Try importing more candles from an earlier date.'
-            )
-
-        return False, jh.timestamp_to_date(first_backtestable_timestamp), jh.timestamp_to_date(last_existing_candle), None
-        raise CandleNotFoundInDatabase(
-            f'Not enough candles for {exchange} {symbol} exists to run backtest from {start_date_str} => {finish_date_str}. \n'
-            f'First available date is {jh.timestamp_to_date(first_backtestable_timestamp)}\n'
-            f'Last available date is {jh.timestamp_to_date(last_existing_candle)}'
-        )
-
-    return True, None, None, None
+    return pre_start_date, pre_finish_date, short_candles_count
 
 
-def inject_required_candles_to_store(candles: np.ndarray, exchange: str, symbol: str) -> None:
+def get_candle_coverage(exchange: str, symbols: list, pre_start_date=None, pre_finish_date=None) -> dict:
+    """
+    one aggregate query for all symbols instead of loading candles.
+    returns symbol -> (first timestamp, last timestamp, candle count, candles between
+    pre_start_date and pre_finish_date). Symbols without candles are missing.
+    """
+    columns = [Candle.symbol, fn.MIN(Candle.timestamp), fn.MAX(Candle.timestamp), fn.COUNT(Candle.id)]
+    if pre_start_date is not None:
+        columns.append(fn.SUM(Case(None, [(Candle.timestamp.between(pre_start_date, pre_finish_date), 1)], 0)))
+
+    coverage = {}
+    for row in Candle.select(*columns).where(
+            Candle.exchange == exchange,
+            Candle.symbol.in_(list(symbols))
+    ).group_by(Candle.symbol).tuples():
+        symbol, first, last, count = row[:4]
+        coverage[symbol] = (int(first), int(last), int(count), int(row[4]) if len(row) > 4 else None)
+    return coverage
+
+
+def load_coverage_index() -> dict:
+    if not COVERAGE_INDEX_PATH.is_file():
+        return {}
+    with open(COVERAGE_INDEX_PATH, 'r') as handle:
+        return json.load(handle)
+
+
+def update_coverage_index(exchange: str, symbols: list, coverage: dict) -> None:
+    """
+    stores first/last timestamp and count of the symbols' candles as returned by get_candle_coverage()
+    """
+    COVERAGE_INDEX_PATH.parent.mkdir(parents=True, exist_ok=True)
+    with file_lock(COVERAGE_INDEX_PATH.with_suffix('.lock')):
+        index = load_coverage_index()
+        for symbol in symbols:
+            key = jh.key(exchange, symbol)
+            if symbol in coverage:
+                first, last, count, _ = coverage[symbol]
+                index[key] = {'first': first, 'last': last, 'count': count}
+            else:
+                index.pop(key, None)
+        fd, tmp_path = tempfile.mkstemp(dir=COVERAGE_INDEX_PATH.parent, suffix='.tmp')
+        with os.fdopen(fd, 'w') as handle:
+            json.dump(index, handle)
+        os.replace(tmp_path, COVERAGE_INDEX_PATH)
+
+
+def _coverage_from_index(index: dict, exchange: str, symbol: str, pre_start_date: int, pre_finish_date: int):
     """
-    generate and add required candles to the candle store
+    coverage of a symbol without gaps can be answered from the index without a query
     """
-    # batch add 1m candles:
-    store.candles.batch_add_candle(candles, exchange, symbol, '1m', with_generation=False)
+    entry = index.get(jh.key(exchange, symbol))
+    if entry is None or entry['count'] != (entry['last'] - entry['first']) // 60_000 + 1:
+        return None
+    overlap_start = max(entry['first'], pre_start_date)
+    overlap_finish = min(entry['last'], pre_finish_date)
+    warmup_count = max(0, (overlap_finish - overlap_start) // 60_000 + 1)
+    return entry['first'], entry['last'], entry['count'], warmup_count
+
+
+def _check_coverage(exchange: str, symbol: str, pre_start_date: int, pre_finish_date: int,
+                    short_candles_count: int, coverage):
+    """
+    same result as get_first_and_last_date() but from the aggregated coverage of the symbol
+    """
+    if coverage is None:
+        return False, None, None, f'No candle for {exchange} {symbol} is present in the database. Try importing candles.'
+
+    first_existing_candle, last_existing_candle, _, warmup_count = coverage
+    if warmup_count >= short_candles_count + 1:
+        return True, None, None, None
+
+    first_backtestable_timestamp = first_existing_candle + (pre_finish_date - pre_start_date) + (60_000 * 1440)
+
+    # if first backtestable timestamp is in the future, that means we have some but not enough candles
+    if first_backtestable_timestamp > jh.today_to_timestamp():
+        return False, jh.timestamp_to_date(first_backtestable_timestamp), jh.timestamp_to_date(last_existing_candle), f'Not enough candle for {exchange} {symbol} is present in the database. Jesse requires "210 * biggest_timeframe" warm-up candles. Try importing more candles from an earlier date.'
+
+    return False, jh.timestamp_to_date(first_backtestable_timestamp), jh.timestamp_to_date(last_existing_candle), None
+
+
+def get_first_and_last_dates(exchange: str, symbols: list, start_date_str: str, finish_date_str: str) -> dict:
+    """
+    get_first_and_last_date() for many symbols with a single database query.
+    returns symbol -> (success, first backtestable date, last date, message)
+    """
+    pre_start_date, pre_finish_date, short_candles_count = _get_warmup_range(start_date_str, finish_date_str)
+
+    # symbols with enough candles according to the coverage index need no query at all.
+    # everything else (unknown, gaps or not enough candles) is checked against the database,
+    # in case candles were imported without updating the index.
+    index = load_coverage_index()
+    results = {}
+    for symbol in symbols:
+        coverage = _coverage_from_index(index, exchange, symbol, pre_start_date, pre_finish_date)
+        if coverage is not None:
+            result = _check_coverage(exchange, symbol, pre_start_date, pre_finish_date, short_candles_count, coverage)
+            if result[0]:
+                results[symbol] = result
+
+    unchecked = [symbol for symbol in symbols if symbol not in results]
+    if unchecked:
+        coverage = get_candle_coverage(exchange, unchecked, pre_start_date, pre_finish_date)
+        update_coverage_index(exchange, unchecked, coverage)
+        for symbol in unchecked:
+            results[symbol] = _check_coverage(exchange, symbol, pre_start_date, pre_finish_date,
+                                              short_candles_count, coverage.get(symbol))
+    return results
+
+
+def import_candles_for_symbols(exchange: str, symbols: list, start_date_str: str, max_workers: int = 4,
+                               importer=import_candles) -> dict:
+    """
+    imports the candles of all symbols with at most max_workers parallel imports.
+    Symbols whose candles from start_date until today are already complete in the
+    database are skipped, symbols with complete but outdated candles are only imported
+    from their last candle on. returns symbol -> error message of failed imports.
+    """
+    symbols = list(dict.fromkeys(symbols))
+    start_date = jh.arrow_to_timestamp(arrow.get(start_date_str, 'YYYY-MM-DD'))
+    # the last complete day
+    last_needed = jh.today_to_timestamp() - 60_000
+    coverage = get_candle_coverage(exchange, symbols)
+    update_coverage_index(exchange, symbols, coverage)
 
-    # loop to generate, and add candles (without execution)
-    for i in range(len(candles)):
-        for timeframe in config['app']['considering_timeframes']:
-            # skip 1m. already added
-            if timeframe == '1m':
+    imports = {}
+    for symbol in symbols:
+        if symbol in coverage:
+            first, last, count, _ = coverage[symbol]
+            is_contiguous = count == (last - first) // 60_000 + 1
+            if first <= start_date and is_contiguous:
+                if last >= last_needed:
+                    print(f"candles of {symbol} are already imported")
+                    continue
+                imports[symbol] = jh.timestamp_to_date(last)
                 continue
+        imports[symbol] = start_date_str
 
-            num = jh.timeframe_to_one_minutes(timeframe)
-
-            if (i + 1) % num == 0:
-                generated_candle = generate_candle_from_one_minutes(
-                    timeframe,
-                    candles[(i - (num - 1)):(i + 1)],
-                    True
-                )
-
-                store.candles.add_candle(
-                    generated_candle,
-                    exchange,
-                    symbol,
-                    timeframe,
-                    with_execution=False,
-                    with_generation=False
-                )
+    errors = {}
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {}
+        for symbol, import_start_date in imports.items():
+            print(f"importing candles of {symbol} from {import_start_date} ...")
+            futures[symbol] = executor.submit(importer, exchange, symbol, import_start_date, max_workers == 1)
+        for symbol, future in futures.items():
+            try:
+                future.result()
+            except Exception as err:
+                errors[symbol] = str(err)
+                print(f"importing candles of {symbol} failed: {err}")
+
+    if imports:
+        update_coverage_index(exchange, list(imports), get_candle_coverage(exchange, list(imports)))
+    return errors
+
+
+def generate_candles_from_one_minutes(candles: np.ndarray, timeframe: str) -> np.ndarray:
+    """
+    all completed candles of the timeframe at once. Same result as calling jesse's
+    generate_candle_from_one_minutes for every block of 1m candles.
+    """
+    num = jh.timeframe_to_one_minutes(timeframe)
+    count = len(candles) // num
+    blocks = np.asarray(candles[:count * num]).reshape(count, num, 6)
+
+    generated = np.empty((count, 6))
+    generated[:, 0] = blocks[:, 0, 0]
+    generated[:, 1] = blocks[:, 0, 1]
+    generated[:, 2] = blocks[:, -1, 2]
+    generated[:, 3] = blocks[:, :, 3].max(axis=1)
+    generated[:, 4] = blocks[:, :, 4].min(axis=1)
+    generated[:, 5] = blocks[:, :, 5].sum(axis=1)
+    return generated
+
+
+# (exchange, symbol, first timestamp, last timestamp, candle count, checksum, timeframes) -> store snapshot
+_store_snapshots = {}
+_STORE_SNAPSHOTS_MAX_ENTRIES = 16
+
+
+def _get_store_snapshot(candles: np.ndarray, exchange: str, symbol: str, timeframes: tuple) -> np.ndarray:
+    checksum = get_candles_checksum(candles)
+    key = (exchange, symbol, candles[0][0], candles[-1][0], len(candles), checksum, timeframes)
+    snapshot = _store_snapshots.get(key)
+    if snapshot is None:
+        snapshot = _load_store_snapshot(candles, exchange, symbol, checksum, timeframes)
+        if len(_store_snapshots) >= _STORE_SNAPSHOTS_MAX_ENTRIES:
+            _store_snapshots.pop(next(iter(_store_snapshots)))
+        _store_snapshots[key] = snapshot
+    return snapshot
+
+
+def _load_store_snapshot(candles: np.ndarray, exchange: str, symbol: str, checksum: str,
+                         timeframes: tuple) -> np.ndarray:
+    """
+    the candles of all timeframes generated from the warm-up candles, one timeframe after
+    the other. One .npy snapshot per (symbol, window, candles checksum, timeframes), so every
+    worker and every later run maps it read-only from the page cache instead of generating
+    it again, and candles imported again get a new one.
+    """
+    path = WARMUP_DIR / f'{exchange}-{symbol}-{int(candles[0][0])}-{int(candles[-1][0])}-{len(candles)}-' \
+                        f'{checksum}-{"_".join(timeframes)}.npy'
+    try:
+        return np.load(path, mmap_mode='r')
+    except FileNotFoundError:
+        pass
+
+    snapshot = np.concatenate([np.empty((0, 6))] + [generate_candles_from_one_minutes(candles, timeframe)
+                                                    for timeframe in timeframes])
+    WARMUP_DIR.mkdir(parents=True, exist_ok=True)
+    # other workers never map a half written snapshot
+    fd, tmp_path = tempfile.mkstemp(dir=WARMUP_DIR, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as handle:
+        np.save(handle, snapshot)
+    os.replace(tmp_path, path)
+    _evict_warmup_snapshots()
+    return snapshot
+
+
+def _evict_warmup_snapshots() -> None:
+    """
+    deletes the oldest snapshots once there are more than WARMUP_MAX_FILES, down to 90% of it
+    """
+    with os.scandir(WARMUP_DIR) as entries:
+        names = [entry.name for entry in entries if entry.name.endswith('.npy')]
+    if len(names) <= WARMUP_MAX_FILES:
+        return
+
+    files = []
+    for name in names:
+        try:
+            files.append((os.stat(WARMUP_DIR / name).st_mtime, WARMUP_DIR / name))
+        except FileNotFoundError:
+            continue
+    for _, f in sorted(files)[:max(len(files) - WARMUP_MAX_FILES * 9 // 10, 0)]:
+        try:
+            f.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def _can_fill(arr) -> bool:
+    """
+    whether _fill_storage can write the storage directly: an empty DynamicNumpyArray that
+    doesn't drop old candles (live) and has the attributes of the jesse versions it was
+    written against
+    """
+    return (isinstance(getattr(arr, 'array', None), np.ndarray) and isinstance(getattr(arr, 'index', None), int)
+            and isinstance(getattr(arr, 'bucket_size', None), int) and getattr(arr, 'drop_at', None) is None
+            and arr.index == -1)
+
+
+def _fill_storage(candles: np.ndarray, exchange: str, symbol: str, timeframe: str) -> None:
+    """
+    copies the candles into the empty candle storage of the route at once instead of
+    appending them one by one
+    """
+    arr = store.candles.get_storage(exchange, symbol, timeframe)
+    count = len(candles)
+    # the capacity the DynamicNumpyArray would have grown to by appending the candles
+    array = np.zeros((arr.bucket_size * (count // arr.bucket_size + 1),) + arr.array.shape[1:], dtype=arr.array.dtype)
+    array[:count] = candles
+    arr.array = array
+    arr.index = count - 1
+
+
+def inject_required_candles_to_store(candles: np.ndarray, exchange: str, symbol: str) -> None:
+    """
+    generate and add required candles to the candle store.
+    the higher timeframes are restored from a snapshot of the prepared store (see
+    _load_store_snapshot) and every storage is filled with a single copy, so the
+    warm-up candles are neither generated nor appended candle by candle again.
+    """
+    timeframes = tuple(timeframe for timeframe in config['app']['considering_timeframes'] if timeframe != '1m')
+    if not len(candles) or not all(_can_fill(store.candles.get_storage(exchange, symbol, timeframe))
+                                   for timeframe in ('1m',) + timeframes):
+        _jesse_inject_required_candles_to_store(candles, exchange, symbol)
+        return
+
+    _fill_storage(candles, exchange, symbol, '1m')
+    snapshot = _get_store_snapshot(candles, exchange, symbol, timeframes)
+    offset = 0
+    for timeframe in timeframes:
+        count = len(candles) // jh.timeframe_to_one_minutes(timeframe)
+        if count:
+            _fill_storage(snapshot[offset:offset + count], exchange, symbol, timeframe)
+        offset += count
+
+
+def install_fast_warmup() -> None:
+    """
+    makes jesse's backtests inject their warm-up candles with the vectorized
+    inject_required_candles_to_store of this module
+    """
+    required_candles.inject_required_candles_to_store = inject_required_candles_to_store
@@ -0,0 +1,42 @@
+import os
+import pathlib
+
+# yaml is imported by the functions, importing this module has to stay cheap for the cli
+RUN_CONFIG_PATH = '.run_optuna_config.yml'
+
+
+def validate_cwd() -> None:
+    """
+    make sure we're in a Jesse project
+    """
+    ls = os.listdir('.')
+    is_jesse_project = 'strategies' in ls and 'storage' in ls
+
+    if not is_jesse_project:
+        print('Current directory is not a Jesse project. You must run commands from the root of a Jesse project.')
+        exit()
+
+
+def get_config(run=False):
+    import yaml
+
+    if run: 
+        cfg_file = pathlib.Path(RUN_CONFIG_PATH)
+    else:
+        cfg_file = pathlib.Path('optuna_config.yml')
+
+    if not cfg_file.is_file():
+        print("{} not found. Run create-config command.".format(cfg_file))
+        exit()
+    else:
+        with open(cfg_file, "r") as ymlfile:
+            cfg = yaml.load(ymlfile, yaml.SafeLoader)
+    return cfg
+
+def update_config(cfg, path=RUN_CONFIG_PATH): 
+    import yaml
+
+    cfg_file = pathlib.Path(path)
+    cfg_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(cfg_file, "w") as ymlfile:
+        yaml.safe_dump(cfg, ymlfile)
@@ -0,0 +1,44 @@
+import gc
+
+GC_POLICIES = ('collect', 'threshold', 'every_n', 'recycle')
+
+# the threshold policy freezes the objects of a process once, not again for every job
+_frozen = False
+
+
+class GcPolicy:
+    """
+    optuna callback that manages python's garbage collector in the workers:
+    collect:   full collection after every trial (optuna's gc_after_trial)
+    threshold: no explicit collection. The generational thresholds are raised and
+               everything alive after the first trial of the process (imports,
+               caches) is frozen, so the automatic collections only scan trial garbage.
+    every_n:   full collection after every n-th trial
+    recycle:   no explicit collection, leaking workers are replaced by fresh
+               processes (recycle_after_trials / recycle_after_growth_mb)
+    """
+    def __init__(self, policy: str = 'collect', every_n: int = 100, thresholds=None):
+        if policy not in GC_POLICIES:
+            raise ValueError(f'The entered gc_policy `{policy}` is unknown. Choose between {", ".join(GC_POLICIES)}.')
+        self.policy = policy
+        self.every_n = every_n
+        self.thresholds = tuple(thresholds or (50000, 20, 20))
+        self._trials = 0
+
+    def __call__(self, study, trial) -> None:
+        global _frozen
+        self._trials += 1
+        if self.policy == 'collect':
+            gc.collect()
+        elif self.policy == 'every_n' and self._trials % self.every_n == 0:
+            gc.collect()
+        elif self.policy == 'threshold' and not _frozen:
+            # forked workers inherit the frozen objects and the flag
+            _frozen = True
+            gc.collect()
+            gc.freeze()
+            gc.set_threshold(*self.thresholds)
+
+
+def get_gc_policy(cfg) -> GcPolicy:
+    return GcPolicy(cfg.get('gc_policy') or 'collect', cfg.get('gc_every_n') or 100, cfg.get('gc_thresholds'))
@@ -0,0 +1,228 @@
+import decimal
+import hashlib
+import json
+import os
+import pathlib
+import tempfile
+import uuid
+
+import optuna
+import psutil
+
+from .file_lock import file_lock
+
+GRID_DIR = pathlib.Path('storage/jesse-optuna/grid')
+
+
+def get_grid_dimensions(strategy_hps) -> list:
+    """
+    compact (name, type, min, step, count) descriptor of every hyperparameter.
+    Values are never materialized, the grid is only enumerated by index.
+    """
+    dimensions = []
+    for st_hp in strategy_hps:
+        if st_hp['type'] is int:
+            step = st_hp.get('step', 1)
+            dimensions.append((st_hp['name'], 'int', st_hp['min'], step, (st_hp['max'] - st_hp['min']) // step + 1))
+        elif st_hp['type'] is float:
+            step = st_hp.get('step', 0.1)
+            count = int(round((st_hp['max'] - st_hp['min']) / step, 9)) + 1
+            dimensions.append((st_hp['name'], 'float', st_hp['min'], step, count))
+        elif st_hp['type'] is bool:
+            dimensions.append((st_hp['name'], 'bool', None, None, 2))
+        else:
+            raise TypeError('Only int, bool and float types are implemented')
+    return dimensions
+
+
+def get_grid_size(dimensions) -> int:
+    size = 1
+    for dimension in dimensions:
+        size *= dimension[4]
+    return size
+
+
+def decode_grid_index(dimensions, index: int) -> dict:
+    """
+    parameters of the index-th grid point (mixed radix, the first parameter changes fastest)
+    """
+    params = {}
+    for name, kind, low, step, count in dimensions:
+        index, digit = divmod(index, count)
+        if kind == 'int':
+            params[name] = low + digit * step
+        elif kind == 'float':
+            params[name] = round(low + digit * step, max(-decimal.Decimal(str(step)).as_tuple().exponent, 0))
+        else:
+            params[name] = digit == 0
+    return params
+
+
+class StreamingGridSampler(optuna.samplers.BaseSampler):
+    """
+    exhaustive grid search that streams the grid points by index instead of building
+    the cartesian product. Workers claim chunks of consecutive indices from a locked
+    checkpoint file, so a sweep is spread over all workers and can be resumed. A job
+    hands the unsampled rest of its chunk back when it ends (release_grid_chunks()),
+    chunks of a previous run or of a dead process are handed out again as a whole.
+    The trial budget is capped at get_remaining(), a trial that finds the grid handed
+    out anyway (another run on the same checkpoint) is pruned instead of repeating a
+    grid point.
+    """
+    def __init__(self, strategy_hps, study_name: str, chunk_size: int = 64):
+        self.dimensions = get_grid_dimensions(strategy_hps)
+        self.size = get_grid_size(self.dimensions)
+        self.chunk_size = chunk_size
+        self.path = GRID_DIR / f'{study_name}.json'
+        self.grid_hash = hashlib.sha1(json.dumps(self.dimensions).encode()).hexdigest()
+        # chunks claimed by other runs than this one were left unfinished
+        self.run_id = uuid.uuid4().hex
+        self._init_job()
+
+    def _init_job(self):
+        # every job gets its own copy of the sampler, chunks are owned per copy
+        self.owner_id = uuid.uuid4().hex
+        self._chunk = None  # [next index, end, start] of this job
+        self._current = None  # (trial number, grid index, params) of this job
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_job()
+
+    def infer_relative_search_space(self, study, trial):
+        return {}
+
+    def sample_relative(self, study, trial, search_space):
+        return {}
+
+    def sample_independent(self, study, trial, param_name, param_distribution):
+        if self._current is None or self._current[0] != trial.number:
+            index = self._next_index()
+            if index is None:
+                study.stop()
+                raise optuna.TrialPruned('the whole grid was handed out')
+            self._current = (trial.number, index, decode_grid_index(self.dimensions, index))
+        return self._current[2][param_name]
+
+    def get_grid_index(self, trial_number: int):
+        """
+        grid index this job sampled for the trial, None if it sampled another trial since
+        """
+        if self._current is None or self._current[0] != trial_number:
+            return None
+        return self._current[1]
+
+    def _next_index(self):
+        if self._chunk is None or self._chunk[0] >= self._chunk[1]:
+            self._chunk = self._claim_chunk(self._chunk)
+            if self._chunk is None:
+                _claiming.pop(self.owner_id, None)
+                return None
+            _claiming[self.owner_id] = self
+        index = self._chunk[0]
+        self._chunk[0] += 1
+        return index
+
+    def _claim_chunk(self, finished):
+        GRID_DIR.mkdir(parents=True, exist_ok=True)
+        with file_lock(self.path.with_suffix('.lock')):
+            checkpoint = self._read_checkpoint()
+            if finished is not None:
+                checkpoint['claimed'].pop(str(finished[2]), None)
+
+            chunk = None
+            if checkpoint['free']:
+                start, end = checkpoint['free'].pop(0)
+                if end - start > self.chunk_size:
+                    checkpoint['free'].insert(0, [start + self.chunk_size, end])
+                    end = start + self.chunk_size
+                chunk = [start, end, start]
+            if chunk is None:
+                for start, (end, run_id, pid, owner_id) in checkpoint['claimed'].items():
+                    if self._is_abandoned(run_id, pid, owner_id):
+                        chunk = [int(start), end, int(start)]
+                        break
+            if chunk is None and checkpoint['next'] < self.size:
+                start = checkpoint['next']
+                checkpoint['next'] = min(start + self.chunk_size, self.size)
+                chunk = [start, checkpoint['next'], start]
+            if chunk is not None:
+                checkpoint['claimed'][str(chunk[2])] = [chunk[1], self.run_id, os.getpid(), self.owner_id]
+            self._write_checkpoint(checkpoint)
+        return chunk
+
+    def _is_abandoned(self, run_id, pid, owner_id) -> bool:
+        """
+        whether nobody is sampling a claimed chunk anymore: it was claimed by an earlier
+        run, by a process that died or by a job of this process that ended without release()
+        """
+        if run_id != self.run_id:
+            return True
+        if pid == os.getpid():
+            return owner_id not in _claiming
+        return not psutil.pid_exists(pid)
+
+    def release(self) -> None:
+        """
+        hands the grid points of the claimed chunk this job didn't sample back to the
+        checkpoint, the sampled ones are done
+        """
+        _claiming.pop(self.owner_id, None)
+        if self._chunk is None:
+            return
+        next_index, end, start = self._chunk
+        self._chunk = None
+        with file_lock(self.path.with_suffix('.lock')):
+            checkpoint = self._read_checkpoint()
+            if checkpoint['claimed'].pop(str(start), None) is not None and next_index < end:
+                checkpoint['free'].append([next_index, end])
+            self._write_checkpoint(checkpoint)
+
+    def get_remaining(self) -> int:
+        """
+        grid points that weren't handed out yet plus the ones handed back and the chunks
+        that are claimed right now or were left unfinished
+        """
+        GRID_DIR.mkdir(parents=True, exist_ok=True)
+        with file_lock(self.path.with_suffix('.lock')):
+            checkpoint = self._read_checkpoint()
+        return (self.size - checkpoint['next']
+                + sum(end - start for start, end in checkpoint['free'])
+                + sum(claimed[0] - int(start) for start, claimed in checkpoint['claimed'].items()))
+
+    def _read_checkpoint(self) -> dict:
+        if self.path.is_file():
+            with open(self.path, 'r') as handle:
+                checkpoint = json.load(handle)
+            if checkpoint['grid_hash'] == self.grid_hash and 'free' in checkpoint:
+                return checkpoint
+        return self._new_checkpoint()
+
+    def _new_checkpoint(self) -> dict:
+        return {'grid_hash': self.grid_hash, 'size': self.size, 'next': 0, 'free': [], 'claimed': {}}
+
+    def _write_checkpoint(self, checkpoint) -> None:
+        fd, tmp_path = tempfile.mkstemp(dir=GRID_DIR, suffix='.tmp')
+        with os.fdopen(fd, 'w') as handle:
+            json.dump(checkpoint, handle)
+        os.replace(tmp_path, self.path)
+
+    def reset(self) -> None:
+        """
+        starts the sweep from the first grid point, used when the study is created again
+        """
+        GRID_DIR.mkdir(parents=True, exist_ok=True)
+        with file_lock(self.path.with_suffix('.lock')):
+            self._write_checkpoint(self._new_checkpoint())
+
+
+# samplers of this process that hold a claimed chunk, by owner id
+_claiming = {}
+
+
+def release_grid_chunks() -> None:
+    """
+    hands the unsampled grid points of every job of this process back, called when a job ends
+    """
+    for sampler in list(_claiming.values()):
+        sampler.release()
@@ -0,0 +1,180 @@
+import copy
+
+import numpy as np
+import optuna
+
+from .storages import _CachedStorage
+
+_UNFINISHED = (optuna.trial.TrialState.RUNNING, optuna.trial.TrialState.WAITING)
+
+
+class HistoryCachedSampler(optuna.samplers.BaseSampler):
+    """
+    wraps a sampler (TPESampler, NSGAIISampler) and keeps the trial history of the study
+    in the worker. Every sync only fetches the trials that were created since the last
+    sync and the ones that were still running, instead of all trials of the study. The
+    wrapped sampler reads this history instead of the storage.
+
+    With history_size the wrapped sampler only sees the latest history_size finished
+    trials plus the best tenth of that number, so the cost of fitting TPE stays flat as
+    the study grows. NSGA-II needs the complete history to find its generations, so
+    history_size is ignored for it.
+
+    Relies on optuna internals (study._storage, study._study_id, study._get_trials and
+    the RDB models in storages.py), which is why setup.py pins optuna below 4.
+    """
+    def __init__(self, sampler: optuna.samplers.BaseSampler, history_size=None):
+        self.sampler = sampler
+        self.history_size = None if isinstance(sampler, optuna.samplers.NSGAIISampler) else history_size
+        self._reset(None)
+
+    def _reset(self, study_id) -> None:
+        self._study_id = study_id
+        self._finished = []  # frozen trials ordered by number
+        self._numbers = np.empty(0, dtype=np.int64)
+        self._values = np.empty(0, dtype=np.float64)  # first objective, nan if not complete
+        self._unfinished = {}  # number -> frozen trial
+        self._current = None  # the trial that is being sampled
+        # numbers above _max_number weren't seen yet, numbers in _missing were skipped
+        # because their trial was committed after a trial with a higher number
+        self._max_number = -1
+        self._missing = set()
+
+    def __getstate__(self):
+        # every worker builds its own history
+        state = self.__dict__.copy()
+        state.update(_study_id=None, _finished=[], _numbers=np.empty(0, dtype=np.int64),
+                     _values=np.empty(0, dtype=np.float64), _unfinished={}, _current=None, _max_number=-1,
+                     _missing=set())
+        return state
+
+    def _fetch(self, study, current_number) -> list:
+        """
+        trials created since the last sync and the ones that were unfinished or skipped,
+        except the trial that is being sampled. Unfinished trials are fetched again, so the
+        history sees the parameters they got since (constant liar). The cached RDB storage
+        of storages.get_storage loads only these rows, in one batched query. In memory and
+        journal storages hold all trials anyway, they are filtered here.
+        """
+        pending = set(self._unfinished) | self._missing
+        if isinstance(study._storage, _CachedStorage):
+            trials = study._storage.get_trials_after(study._study_id, self._max_number, pending)
+        else:
+            trials = [t for t in study._storage.get_all_trials(study._study_id, deepcopy=False)
+                      if t.number > self._max_number or t.number in pending]
+        return [t for t in trials if t.number != current_number]
+
+    def sync(self, study, current_number=None) -> None:
+        if study._study_id != self._study_id:
+            self._reset(study._study_id)
+
+        finished = []
+        for trial in self._fetch(study, current_number):
+            self._missing.discard(trial.number)
+            if trial.number > self._max_number:
+                self._missing.update(range(self._max_number + 1, trial.number))
+                self._max_number = trial.number
+            if trial.state in _UNFINISHED:
+                self._unfinished[trial.number] = trial
+            else:
+                self._unfinished.pop(trial.number, None)
+                finished.append(trial)
+        # numbers of trials fetched in the same sync aren't missing
+        self._missing.difference_update(self._unfinished)
+        self._missing.difference_update(t.number for t in finished)
+        if not finished:
+            return
+
+        finished.sort(key=lambda t: t.number)
+        values = [t.values[0] if t.state == optuna.trial.TrialState.COMPLETE else np.nan for t in finished]
+        last = self._numbers[-1] if len(self._numbers) else -1
+        appended = []
+        for trial, value in zip(finished, values):
+            if trial.number > last:
+                appended.append((trial, value))
+                continue
+            # finished after trials with higher numbers, the history stays ordered by number
+            position = int(np.searchsorted(self._numbers, trial.number))
+            self._finished.insert(position, trial)
+            self._numbers = np.insert(self._numbers, position, trial.number)
+            self._values = np.insert(self._values, position, value)
+        self._finished.extend(trial for trial, _ in appended)
+        self._numbers = np.concatenate([self._numbers, np.array([t.number for t, _ in appended], dtype=np.int64)])
+        self._values = np.concatenate([self._values, np.array([v for _, v in appended], dtype=np.float64)])
+
+    def get_trials(self, study, states=None) -> list:
+        """
+        the history the wrapped sampler sees, ordered by number
+        """
+        finished = self._finished
+        if self.history_size is not None and len(finished) > self.history_size:
+            recent = np.arange(len(finished) - self.history_size, len(finished))
+            values = self._values[:len(finished) - self.history_size]
+            if study.direction == optuna.study.StudyDirection.MAXIMIZE:
+                values = -values
+            n_best = min(self.history_size // 10, int(np.count_nonzero(~np.isnan(values))))
+            best = np.argsort(np.where(np.isnan(values), np.inf, values), kind='stable')[:n_best]
+            finished = [self._finished[i] for i in np.concatenate([np.sort(best), recent])]
+
+        if states is None or any(state in states for state in _UNFINISHED):
+            unfinished = list(self._unfinished.values())
+            if self._current is not None and self._current.number not in self._unfinished:
+                unfinished.append(self._current)
+            trials = sorted(finished + unfinished, key=lambda t: t.number)
+        else:
+            trials = finished
+        if states is None and trials and len(trials) != trials[-1].number + 1 and self.history_size is None:
+            # NSGA-II looks trials up by number, a trial that wasn't committed at the last sync
+            # would shift the list
+            return study._get_trials(deepcopy=False, use_cache=True)
+        if states is not None:
+            trials = [t for t in trials if t.state in states]
+        return trials
+
+    def infer_relative_search_space(self, study, trial):
+        return self.sampler.infer_relative_search_space(self._view(study), trial)
+
+    def sample_relative(self, study, trial, search_space):
+        return self.sampler.sample_relative(self._view(study), trial, search_space)
+
+    def sample_independent(self, study, trial, param_name, param_distribution):
+        return self.sampler.sample_independent(self._view(study), trial, param_name, param_distribution)
+
+    def before_trial(self, study, trial) -> None:
+        self.sync(study, trial.number)
+        self._current = trial
+        self.sampler.before_trial(self._view(study), trial)
+
+    def after_trial(self, study, trial, state, values) -> None:
+        self.sampler.after_trial(self._view(study), trial, state, values)
+
+    def reseed_rng(self) -> None:
+        self.sampler.reseed_rng()
+
+    def _view(self, study):
+        return _HistoryStudy(study, self)
+
+
+class _HistoryStudy:
+    """
+    the study as the wrapped sampler sees it, trials come from the history
+    """
+    def __init__(self, study, sampler: HistoryCachedSampler):
+        self._study = study
+        self._history_sampler = sampler
+
+    def __getattr__(self, name):
+        return getattr(self._study, name)
+
+    def get_trials(self, deepcopy=True, states=None) -> list:
+        return self._get_trials(deepcopy, states)
+
+    def _get_trials(self, deepcopy=True, states=None, use_cache=False) -> list:
+        trials = self._history_sampler.get_trials(self._study, states)
+        if deepcopy:
+            return copy.deepcopy(trials)
+        return trials
+
+    @property
+    def trials(self) -> list:
+        return self._get_trials()
@@ -0,0 +1,146 @@
+import hashlib
+import inspect
+import json
+import os
+import sqlite3
+import time
+
+import jesse.helpers as jh
+import numpy as np
+
+from .candle_cache import get_candles_fingerprint
+
+MEMO_PATH = 'storage/jesse-optuna/memo.sqlite'
+
+# settings of the run config that change the result of a backtest
+_BACKTEST_SETTINGS = ('strategy_name', 'exchange', 'symbol', 'timeframe', 'starting_balance', 'fee',
+                      'futures_leverage', 'futures_leverage_mode', 'settlement_currency', 'warm_up_candles',
+                      'extra_routes')
+
+# strategy name -> hash of its directory, per process
+_strategy_hashes = {}
+# path -> BacktestMemo of this process
+_memos = {}
+_jesse_version = None
+
+
+def _to_json(value):
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, np.floating):
+        return float(value)
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f'{type(value)} is not JSON serializable')
+
+
+def _get_strategy_hash(strategy_name: str) -> str:
+    """
+    hash of every file in the directory of the strategy, helpers and data files next to
+    the strategy class change its results too
+    """
+    if strategy_name not in _strategy_hashes:
+        strategy_dir = os.path.dirname(inspect.getfile(jh.get_strategy_class(strategy_name)))
+        digest = hashlib.sha256()
+        for root, dirs, files in os.walk(strategy_dir):
+            dirs[:] = sorted(d for d in dirs if d != '__pycache__')
+            for name in sorted(files):
+                if name.endswith('.pyc'):
+                    continue
+                path = os.path.join(root, name)
+                digest.update(os.path.relpath(path, strategy_dir).encode() + b'\0')
+                with open(path, 'rb') as handle:
+                    digest.update(hashlib.sha256(handle.read()).digest())
+        _strategy_hashes[strategy_name] = digest.hexdigest()
+    return _strategy_hashes[strategy_name]
+
+
+def _get_jesse_version() -> str:
+    global _jesse_version
+    if _jesse_version is None:
+        try:
+            from importlib.metadata import version
+        except ImportError:  # python 3.7
+            from pkg_resources import get_distribution
+            _jesse_version = get_distribution('jesse').version
+        else:
+            _jesse_version = version('jesse')
+    return _jesse_version
+
+
+def get_memo_key(start_date: str, finish_date: str, hp, cfg) -> str:
+    """
+    content address of a backtest: strategy (including its source), jesse version, market,
+    timespan, the candles of every route, parameters and the balance and fee settings
+    """
+    content = {key: cfg.get(key) for key in _BACKTEST_SETTINGS}
+    routes = [(cfg['exchange'], cfg['symbol'])] + [(route['exchange'], route['symbol'])
+                                                   for route in (cfg.get('extra_routes') or {}).values()]
+    content.update(strategy_hash=_get_strategy_hash(cfg['strategy_name']), jesse_version=_get_jesse_version(),
+                   candles=[get_candles_fingerprint(exchange, symbol, start_date, finish_date,
+                                                    cfg.get('candle_cache_max_size_mb'))
+                            for exchange, symbol in routes],
+                   start_date=start_date, finish_date=finish_date, hp=dict(hp))
+    raw = json.dumps(content, sort_keys=True, default=_to_json, separators=(',', ':'))
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class BacktestMemo:
+    """
+    backtest metrics by content address in a SQLite file shared by all workers and
+    kept between study restarts. Once the file grows above max_size_mb the least
+    recently used results are deleted.
+    """
+    def __init__(self, path: str = MEMO_PATH, max_size_mb=None):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.max_size_mb = max_size_mb
+        self.pid = os.getpid()
+        self._puts = 0
+        self._connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS results '
+                                 '(key TEXT PRIMARY KEY, metrics TEXT NOT NULL, last_access REAL NOT NULL)')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access)')
+
+    def get(self, key: str):
+        row = self._connection.execute('SELECT metrics FROM results WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        self._connection.execute('UPDATE results SET last_access = ? WHERE key = ?', (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key: str, metrics: dict) -> None:
+        self._connection.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?)',
+                                 (key, json.dumps(metrics, default=_to_json), time.time()))
+        self._puts += 1
+        if self.max_size_mb is not None and self._puts % 100 == 0:
+            self.evict()
+
+    def evict(self) -> None:
+        """
+        deletes the least recently used tenth of the results if the file is too large
+        """
+        page_count = self._connection.execute('PRAGMA page_count').fetchone()[0]
+        freelist_count = self._connection.execute('PRAGMA freelist_count').fetchone()[0]
+        page_size = self._connection.execute('PRAGMA page_size').fetchone()[0]
+        if (page_count - freelist_count) * page_size <= self.max_size_mb * 1024 * 1024:
+            return
+        self._connection.execute(
+            'DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY last_access LIMIT '
+            '(SELECT COUNT(*) / 10 + 1 FROM results))')
+
+    def close(self) -> None:
+        self._connection.close()
+
+
+def get_memo(max_size_mb=None, path: str = MEMO_PATH) -> BacktestMemo:
+    """
+    returns the memo of this process, connections can't be shared with forked workers
+    """
+    memo = _memos.get(path)
+    if memo is None or memo.pid != os.getpid():
+        memo = BacktestMemo(path, max_size_mb)
+        _memos[path] = memo
+    memo.max_size_mb = max_size_mb
+    return memo
@@ -0,0 +1,931 @@
+import copy
+import functools
+import logging
+import os
+import shutil
+from time import sleep
+import traceback
+import json
+
+import click
+import jesse.helpers as jh
+import numpy as np
+import pandas as pd
+import optuna
+from jesse.research import backtest
+from .JoblilbStudy import JoblibStudy, optimize_concurrently
+from .candle_cache import get_candles_with_cache
+from .config import RUN_CONFIG_PATH, get_config, update_config, validate_cwd
+from .gc_policy import get_gc_policy
+from .grid import StreamingGridSampler, release_grid_chunks
+from .history_sampler import HistoryCachedSampler
+from .memo import get_memo, get_memo_key
+from .result_sink import compact_results, empty_backtest_data, flush_results, get_result_columns, read_results
+from .storages import get_round_trips, get_storage
+from .candledates import get_first_and_last_dates, import_candles_for_symbols, install_fast_warmup
+from .trial_context import get_csv_path, get_results_path, get_run_config_path, get_study_name, get_trial_context
+from .worker_pool import WorkerPool
+
+
+# trials with a larger drawdown in the training timespan are rejected
+MAX_TRAINING_DRAWDOWN = -3
+
+logger = logging.getLogger()
+_log_handler = None
+
+optuna.logging.enable_propagation()
+
+
+def setup_logging(mode: str = 'a') -> None:
+    """
+    attaches the jesse-optuna.log handler once per process. The main process truncates
+    the log when a run starts, workers append to it.
+    """
+    global _log_handler
+    if _log_handler is None:
+        _log_handler = logging.FileHandler("jesse-optuna.log", mode=mode)
+        logger.addHandler(_log_handler)
+
+
+def run() -> None:
+    setup_logging('w')
+    cfg = get_config()
+    update_config(cfg)
+    if cfg['n_jobs'] == 1:
+        run_optimization()
+    else:
+        with create_worker_pool(cfg) as pool:
+            run_optimization(pool=pool)
+
+
+def create_worker_pool(cfg) -> WorkerPool:
+    """
+    starts the workers with the configured start method and prints how long they took
+    until jesse and the strategy were imported and how much memory they use
+    """
+    start_method = cfg.get('worker_start_method') or 'forkserver'
+    modules = ['jesse_optuna.optimization', f"strategies.{cfg['strategy_name']}"]
+    if start_method == 'fork':
+        # the workers inherit everything imported before they are forked
+        jh.get_strategy_class(cfg['strategy_name'])
+    pool = WorkerPool(cfg['n_jobs'], start_method, preload=modules, memory_limit_mb=cfg.get('memory_limit_mb'),
+                      min_free_memory_mb=cfg.get('min_free_memory_mb'),
+                      recycle_after_trials=cfg.get('recycle_after_trials'),
+                      recycle_after_growth_mb=cfg.get('recycle_after_growth_mb'))
+    probes = pool.probe(modules)
+    print(f"{pool.n_workers} workers ({pool.start_method}) ready after {max(p['startup_s'] for p in probes):.2f}s, "
+          f"per worker rss {np.mean([p['rss_mb'] for p in probes]):.0f} MB, "
+          f"uss {np.mean([p['uss_mb'] for p in probes]):.0f} MB")
+    return pool
+
+def finish_worker() -> None:
+    """
+    called in every worker after its last trial of a study
+    """
+    release_grid_chunks()
+    flush_results()
+    round_trips, trials = get_round_trips()
+    if trials:
+        logger.info(f"worker {os.getpid()}: {round_trips} storage round-trips in {trials} trials "
+                    f"({round_trips / trials:.1f} per trial)")
+
+
+def run_optimization(batchmode=False, cfg=None, pool=None) -> None:
+    validate_cwd()
+
+    if cfg == None:
+        cfg = get_config()
+    study, study_name = prepare_study(cfg, batchmode)
+
+    print("start optimization")
+    study.optimize(objective, n_jobs=cfg['n_jobs'],
+                   n_trials=get_n_trials(study, cfg['n_trials']),
+                   timeout=cfg.get('timeout'), pool=pool, on_worker_done=finish_worker,
+                   callbacks=[get_gc_policy(cfg)])
+    if cfg.get('results_format') == 'parquet':
+        compact_results(get_results_path(cfg))
+
+    print_best_params(study)
+    save_best_params(study, study_name)
+
+
+def run_concurrent_optimizations(cfgs, pool) -> None:
+    """
+    optimizes the studies of several symbols at the same time on the workers of the pool.
+    Every worker takes its next trial from the study with the most trials left.
+    """
+    validate_cwd()
+
+    studies = []
+    funcs = []
+    for cfg in cfgs:
+        # every study needs its own run config, .run_optuna_config.yml can only hold one
+        run_config_path = get_run_config_path(cfg)
+        update_config(cfg, run_config_path)
+        study, study_name = prepare_study(cfg, batchmode=True)
+        studies.append(study)
+        funcs.append(functools.partial(objective, run_config_path=run_config_path))
+
+    print("start optimization of", [cfg['symbol'] for cfg in cfgs])
+    optimize_concurrently(studies, funcs, [get_n_trials(study, cfg['n_trials']) for study, cfg in zip(studies, cfgs)],
+                          pool, n_jobs=cfgs[0]['n_jobs'],
+                          timeout=cfgs[0].get('timeout'), on_worker_done=finish_worker,
+                          callbacks=[get_gc_policy(cfgs[0])])
+
+    for study, cfg in zip(studies, cfgs):
+        if cfg.get('results_format') == 'parquet':
+            compact_results(get_results_path(cfg))
+        print_best_params(study)
+        save_best_params(study, study.study_name)
+        get_best_candidates(cfg, pool)
+
+
+def get_n_trials(study, n_trials):
+    """
+    a grid sweep takes no more trials than grid points are left
+    """
+    if not isinstance(study.sampler, StreamingGridSampler):
+        return n_trials
+    remaining = study.sampler.get_remaining()
+    return remaining if n_trials is None else min(n_trials, remaining)
+
+
+def prepare_study(cfg, batchmode=False):
+    """
+    creates the csv for the trial results and the study with the configured sampler
+    """
+    print("Run Study for ", cfg['symbol'], " from date: ", cfg['timespan-testing']['start_date'])
+    study_name = get_study_name(cfg)
+    storage = get_storage(cfg)
+
+    os.makedirs('./storage/jesse-optuna/csv', exist_ok=True)
+    if "id" in cfg:
+        os.makedirs('./storage/jesse-optuna/csv/best_candidates/detail', exist_ok=True)
+    path = get_csv_path(cfg)
+
+
+    StrategyClass = jh.get_strategy_class(cfg['strategy_name'])
+    hp_dict = StrategyClass().hyperparameters(cfg['symbol'])
+    print("hp_dict",hp_dict)
+
+    # cache the candle superset covering both timespans before the workers start
+    get_backtest_candles(cfg, min(cfg['timespan-train']['start_date'], cfg['timespan-testing']['start_date']),
+                         max(cfg['timespan-train']['finish_date'], cfg['timespan-testing']['finish_date']))
+    if cfg.get('results_format') != 'parquet' and not jh.file_exists(path):
+        search_data = pd.DataFrame(columns=get_result_columns(hp_dict))
+        with open(path, "w") as f:
+            search_data.to_csv(f, sep="\t", index=False, na_rep='nan', line_terminator='\n')
+
+    if (cfg['sampler'] == 'NSGAIISampler'):
+            sampler = optuna.samplers.NSGAIISampler(population_size=cfg['population_size'], 
+                mutation_prob=cfg['mutation_prob'],  
+                crossover_prob=cfg['crossover_prob'], 
+                swapping_prob=cfg['swapping_prob'])
+
+    elif(cfg['sampler'] == 'TPESampler'):
+        sampler = optuna.samplers.TPESampler(consider_prior=cfg['consider_prior'], 
+            prior_weight=cfg['prior_weight'],
+            consider_magic_clip=cfg['consider_magic_clip'],
+            consider_endpoints=cfg['consider_endpoints'],
+            n_startup_trials=cfg['n_startup_trials'],
+            n_ei_candidates=cfg['n_ei_candidates'],
+            seed=cfg['seed'],
+            multivariate=cfg['multivariate'],
+            group=cfg['group'],
+            warn_independent_sampling=cfg['warn_independent_sampling'],
+            constant_liar=cfg['constant_liar'])
+    elif (cfg['sampler'] == 'GridSampler'):
+        sampler = optuna.samplers.GridSampler(search_space=get_search_space(hp_dict))
+    elif (cfg['sampler'] == 'StreamingGridSampler'):
+        sampler = StreamingGridSampler(hp_dict, study_name if 'id' not in cfg else f'{study_name}_{cfg["id"]}',
+                                       chunk_size=cfg.get('grid_chunk_size') or 64)
+
+    if cfg.get('sampler_history_cache') and cfg['sampler'] in ('NSGAIISampler', 'TPESampler'):
+        sampler = HistoryCachedSampler(sampler, cfg.get('sampler_history_size'))
+
+    pruner_name = cfg.get('pruner') or 'NopPruner'
+    if pruner_name == 'MedianPruner':
+        pruner = optuna.pruners.MedianPruner(n_startup_trials=cfg.get('pruner_startup_trials', 5),
+                                             n_warmup_steps=cfg.get('pruner_warmup_steps', 0))
+    elif pruner_name == 'HyperbandPruner':
+        pruner = optuna.pruners.HyperbandPruner(min_resource=1, max_resource=max(len(get_pruning_checkpoints(cfg)), 1),
+                                                reduction_factor=cfg.get('reduction_factor', 3))
+    elif pruner_name == 'SuccessiveHalvingPruner':
+        pruner = optuna.pruners.SuccessiveHalvingPruner(min_resource=1, reduction_factor=cfg.get('reduction_factor', 3))
+    elif pruner_name == 'NopPruner':
+        pruner = optuna.pruners.NopPruner()
+    else:
+        raise ValueError(f'The entered pruner `{pruner_name}` is unknown. Choose between NopPruner, MedianPruner, '
+                         f'HyperbandPruner and SuccessiveHalvingPruner.')
+
+    optuna.logging.enable_propagation()
+    optuna.logging.disable_default_handler()
+
+    resume = False
+    try:
+        study = JoblibStudy(study_name=study_name, direction="maximize", sampler=sampler, pruner=pruner,
+                                    storage=storage, load_if_exists=False)
+    except optuna.exceptions.DuplicatedStudyError:
+        if batchmode:
+            optuna.delete_study(study_name=study_name, storage=storage)
+            study = JoblibStudy(study_name=study_name, direction="maximize", sampler=sampler, pruner=pruner,
+                                        storage=storage, load_if_exists=False)
+        else:
+            if click.confirm('Previous study detected. Do you want to resume?', default=True):
+                resume = True
+                study = JoblibStudy(study_name=study_name, direction="maximize", sampler=sampler, pruner=pruner,
+                                            storage=storage, load_if_exists=True)
+            elif click.confirm('Delete previous study and start new?', default=False):
+                optuna.delete_study(study_name=study_name, storage=storage)
+                study = JoblibStudy(study_name=study_name, direction="maximize", sampler=sampler, pruner=pruner,
+                                            storage=storage, load_if_exists=False)
+            else:
+                print("Exiting.")
+                exit(1)
+
+    if isinstance(sampler, StreamingGridSampler) and not resume:
+        # a new study sweeps the grid from the start
+        sampler.reset()
+    if cfg.get('results_format') == 'parquet' and not resume:
+        # rows of the deleted study
+        shutil.rmtree(get_results_path(cfg), ignore_errors=True)
+
+    study.set_user_attr("strategy_name", cfg['strategy_name'])
+    study.set_user_attr("exchange", cfg['exchange'])
+    study.set_user_attr("symbol", cfg['symbol'])
+    study.set_user_attr("timeframe", cfg['timeframe'])
+
+    return study, study_name
+
+
+def batchrun() -> None: 
+    validate_cwd()
+    setup_logging('w')
+    cfg = get_config()
+    optuna_batch_path = "optuna_batch.json"
+    optuna_batch_path = os.path.abspath(optuna_batch_path)
+    if not os.path.isfile(optuna_batch_path):
+        print("There is no file with symbols which should be optimized.")
+        sleep(0.5)
+        batch_dict = {
+                    "symbols": ["BTC-USDT", "ETH-USDT"]
+                    }
+        with open(optuna_batch_path, 'w') as outfile:
+            json.dump(batch_dict, outfile, indent=4, sort_keys=True)
+        print("I created a file for you at ", optuna_batch_path , ":)")
+        sleep(0.5)
+        print("Please fill in your symbols and restart with: 'jesse-optuna batchrun' again")
+        sleep(0.5)
+        return
+    else:
+        try:
+            with open(optuna_batch_path, 'r', encoding='UTF-8') as dna_settings: 
+                        batch_dict = json.load(dna_settings)
+        except json.JSONDecodeError: 
+            raise (
+            'DNA Settings file is formatted wrong.'
+            )
+        except:
+            raise
+
+        print("Going to run the optimization for the symbols: ", batch_dict["symbols"])
+
+    import_candles_for_symbols(cfg['exchange'], [str(symbol) for symbol in batch_dict["symbols"]],
+                               cfg['timespan-testing']['start_date'], cfg.get('import_concurrency') or 4)
+
+    # check if candles are imported succesfully for all symbols: 
+    print("checking if all needed candles are imported")
+    dates = get_first_and_last_dates(cfg['exchange'], [str(symbol) for symbol in batch_dict["symbols"]],
+                                     cfg['timespan-testing']['start_date'], cfg['timespan-testing']['finish_date'])
+    start_date_dict = {}
+    for i, symbol in enumerate(batch_dict["symbols"]):
+        succes, start_date, finish_date, message = dates[str(symbol)]
+        if not succes: 
+            if start_date is None:
+                print(message)
+                exit()
+            if not message is None: # if first backtestable timestamp is in the future, that means we have some but not enough candles
+                print("Not Enough candles!")
+                print(message)
+                exit()
+            else:
+                print("First available date is {} for symbol {}".format(start_date, symbol))
+                print("Changing the start date for this symbol")
+                start_date_dict[symbol] = start_date
+                continue
+
+        start_date_dict[symbol] = cfg['timespan-testing']['start_date']
+        
+    print("successfully imported candles")
+
+    concurrent_studies = cfg.get('concurrent_studies') or 1
+
+    # one pool for all studies of the batch, so the workers keep their imports and candle caches
+    with create_worker_pool(cfg) as pool:
+        jobs = []
+        for i, symbol in enumerate(batch_dict["symbols"]):
+            symbol_cfg = copy.deepcopy(cfg)
+            symbol_cfg['timespan-testing']['start_date'] = start_date_dict[symbol]
+            symbol_cfg['symbol'] = symbol
+            jobs.append((symbol_cfg, None))
+        run_batch_studies(jobs, pool, concurrent_studies)
+    
+        # widerange search completed. Lets start with the detail search 
+
+        best_dnas = load_best_dnas_json()
+        best_dnas = clean_best_dnas_json(best_dnas)
+        print(best_dnas)
+        print("Start Detail Search of Coins")
+        jobs = []
+        for i, symbol in enumerate(batch_dict["symbols"]):
+            if not symbol in best_dnas:
+                print("No best candidates found for: ", symbol)
+                continue
+            for bdna in best_dnas[symbol]:
+                symbol_cfg = copy.deepcopy(cfg)
+                symbol_cfg['timespan-testing']['start_date'] = start_date_dict[symbol]
+                symbol_cfg['symbol'] = symbol
+                symbol_cfg['id'] = bdna
+                symbol_cfg['n_trials'] = cfg['n_trials_detail']
+                jobs.append((symbol_cfg, best_dnas[symbol][bdna]))
+        run_batch_studies(jobs, pool, concurrent_studies)
+
+
+def run_batch_studies(jobs, pool, concurrent_studies=1) -> None:
+    """
+    jobs are (cfg, dna) tuples. dna is None for a widerange search, otherwise the
+    hyperparameters the detail search starts from. Up to concurrent_studies studies
+    run at the same time, but never two of the same symbol, because the strategy
+    reads its detail dna per symbol from dna_detail_search.json.
+    """
+    waves = []
+    for cfg, dna in jobs:
+        for wave in waves:
+            if len(wave) < concurrent_studies and all(c['symbol'] != cfg['symbol'] for c, _ in wave):
+                wave.append((cfg, dna))
+                break
+        else:
+            waves.append([(cfg, dna)])
+
+    for wave in waves:
+        for cfg, dna in wave:
+            remove_symbol_from_dna_detail_search_json(cfg['symbol'])
+            if dna is not None:
+                update_dna_detail_search_json(symbol=cfg['symbol'], new_hps=dna)
+                print(dna)
+
+        if len(wave) == 1:
+            cfg = wave[0][0]
+            update_config(cfg)
+            run_optimization(batchmode=True, cfg=cfg, pool=pool)
+            get_best_candidates(cfg, pool)
+        else:
+            run_concurrent_optimizations([cfg for cfg, _ in wave], pool)
+
+
+def load_best_dnas_json():
+    path_best_dnas = f'optuna_best_dnas.json'
+    if os.path.isfile(path_best_dnas):
+        try:
+            with open(path_best_dnas, 'r', encoding='UTF-8') as dna_settings: 
+                best_dnas_dict = json.load(dna_settings)
+        except json.JSONDecodeError: 
+            print(
+            'DNA Settings file is formatted wrong.'
+            )
+            exit()
+        except:
+            raise
+    else:
+        raise
+
+    return best_dnas_dict
+
+def clean_best_dnas_json(json_file):
+    for symbol in json_file:
+        for key in ['testing_real_net_profit_percentage', 'testing_gross_drawdown', 
+                'testing_real_max_drawdown', 'my_ratio2']:
+            if key in json_file[symbol]:
+                json_file[symbol].pop(key)
+    return json_file
+
+def remove_symbol_from_dna_detail_search_json(symbol):
+    dna_detail_search_path = "strategies/RaptorMKIV/dna_detail_search.json"
+    if os.path.isfile(dna_detail_search_path):
+        try:
+            with open(dna_detail_search_path, 'r', encoding='UTF-8') as dna_settings: 
+                dnadds = json.load(dna_settings)
+        except json.JSONDecodeError: 
+            print(
+            'DNA Settings file is formatted wrong.'
+            )
+            exit()
+        except:
+            print("Error")
+    else:
+        raise
+
+    if symbol in dnadds["Coins"]:
+        dnadds["Coins"].pop(symbol)
+    
+    with open(dna_detail_search_path, 'w', encoding='UTF-8') as dna_settings: 
+        json.dump(dnadds, dna_settings, indent=4, sort_keys=True)
+
+def update_dna_detail_search_json(symbol, new_hps):
+    dna_detail_search_path = "strategies/RaptorMKIV/dna_detail_search.json"
+    if os.path.isfile(dna_detail_search_path):
+        try:
+            with open(dna_detail_search_path, 'r', encoding='UTF-8') as dna_settings: 
+                dnadds = json.load(dna_settings)
+        except json.JSONDecodeError: 
+            print(
+            'DNA Settings file is formatted wrong.'
+            )
+            exit()
+        except:
+            raise
+    else:
+        raise
+
+    dnadds["Coins"][symbol] = new_hps
+
+    with open(dna_detail_search_path, 'w', encoding='UTF-8') as dna_settings: 
+        json.dump(dnadds, dna_settings, indent=4, sort_keys=True)
+
+
+def get_search_space(strategy_hps):
+    hp = {}
+    for st_hp in strategy_hps:
+        if st_hp['type'] is int:
+            if 'step' not in st_hp:
+                st_hp['step'] = 1
+            hp[st_hp['name']] = list(range(st_hp['min'], st_hp['max'] + st_hp['step'], st_hp['step']))
+        elif st_hp['type'] is float:
+            if 'step' not in st_hp:
+                st_hp['step'] = 0.1
+            decs = str(st_hp['step'])[::-1].find('.')
+            hp[st_hp['name']] = list(
+                np.trunc(np.arange(st_hp['min'], st_hp['max'] + st_hp['step'], st_hp['step']) * 10 ** decs) / (
+                        10 ** decs))
+        elif st_hp['type'] is bool:
+            hp[st_hp['name']] = [True, False]
+        else:
+            raise TypeError('Only int, bool and float types are implemented')
+    return hp
+
+def objective(trial, run_config_path=RUN_CONFIG_PATH):
+    setup_logging()
+    # parsed run config, strategy hyperparameters and paths are cached per worker process
+    context = get_trial_context(run_config_path)
+    cfg = context.cfg
+
+    for st_hp in context.hp_dict:
+        if st_hp['type'] is int:
+            trial.suggest_int(st_hp['name'], st_hp['min'], st_hp['max'], step=st_hp['step'])
+        elif st_hp['type'] is float:
+            trial.suggest_float(st_hp['name'], st_hp['min'], st_hp['max'], step=st_hp['step'])
+        elif st_hp['type'] is bool:
+            trial.suggest_categorical(st_hp['name'], [True, False])
+        else:
+            raise TypeError('Only int, bool and float types are implemented for strategy parameters.')
+    if isinstance(trial.study.sampler, StreamingGridSampler):
+        trial.set_user_attr('grid_index', trial.study.sampler.get_grid_index(trial.number))
+
+    if (cfg.get('pruner') or 'NopPruner') != 'NopPruner':
+        prune_training(trial, cfg, context.result_sink)
+
+    try:
+        training_data_metrics = backtest_function(cfg['timespan-train']['start_date'],
+                                                  cfg['timespan-train']['finish_date'],
+                                                  trial.params, cfg)
+    except Exception as err:
+        logger.error("".join(traceback.TracebackException.from_exception(err).format()))
+        raise err
+
+
+    if training_data_metrics is None:
+        del training_data_metrics, cfg
+        return np.nan
+
+
+    if training_data_metrics['total'] <= 5:
+        logger.error("%r" % training_data_metrics)
+        del training_data_metrics, cfg
+        return np.nan
+
+    score, ratio = get_score(training_data_metrics, cfg)
+
+    if ratio < 0.8 or training_data_metrics['max_drawdown'] < MAX_TRAINING_DRAWDOWN:
+        context.result_sink.write_result(trial.params, score, training_data_metrics=training_data_metrics,
+                                         testing_data_metrics=None, trial_number=trial.number)
+
+        del training_data_metrics, cfg, ratio
+        return np.nan
+
+    try:
+        testing_data_metrics = backtest_function(cfg['timespan-testing']['start_date'], cfg['timespan-testing']['finish_date'], trial.params, cfg)
+    except Exception as err:
+        logger.error("".join(traceback.TracebackException.from_exception(err).format()))
+        raise err
+
+    if testing_data_metrics is None:
+        del training_data_metrics, cfg, ratio
+        del testing_data_metrics
+        return np.nan
+
+    # a single write per trial instead of one storage round-trip per metric
+    trial.set_user_attr('metrics', get_metrics_attr(training_data_metrics, testing_data_metrics))
+
+    context.result_sink.write_result(trial.params, score, training_data_metrics=training_data_metrics,
+                                     testing_data_metrics=testing_data_metrics, trial_number=trial.number)
+    del training_data_metrics
+    del testing_data_metrics
+    return score
+
+
+def get_metrics_attr(training_data_metrics, testing_data_metrics) -> dict:
+    """
+    the metrics of both backtests as one json serializable user attr
+    (trial.user_attrs['metrics']['training-net_profit'], ...)
+    """
+    metrics = {}
+    for prefix, data_metrics in (('testing', testing_data_metrics), ('training', training_data_metrics)):
+        for key, value in data_metrics.items():
+            if isinstance(value, np.integer):
+                value = int(value)
+            elif isinstance(value, np.floating):
+                value = float(value)
+            elif isinstance(value, np.ndarray):
+                value = value.tolist()
+            metrics[f"{prefix}-{key}"] = value
+    return metrics
+
+
+def get_score(metrics, cfg):
+    """
+    returns the fitness score and the configured ratio of the backtest metrics
+    """
+    total_effect_rate = np.log10(metrics['total']) / np.log10(cfg['optimal-total'])
+    total_effect_rate = min(total_effect_rate, 1)
+    ratio_config = cfg['fitness-ratio']
+    if ratio_config == 'sharpe':
+        ratio = metrics['sharpe_ratio']
+        ratio_normalized = jh.normalize(ratio, -.5, 5)
+    elif ratio_config == 'calmar':
+        ratio = metrics['calmar_ratio']
+        ratio_normalized = jh.normalize(ratio, -.5, 30)
+    elif ratio_config == 'sortino':
+        ratio = metrics['sortino_ratio']
+        ratio_normalized = jh.normalize(ratio, -.5, 15)
+    elif ratio_config == 'omega':
+        ratio = metrics['omega_ratio']
+        ratio_normalized = jh.normalize(ratio, -.5, 5)
+    elif ratio_config == 'serenity':
+        ratio = metrics['serenity_index']
+        ratio_normalized = jh.normalize(ratio, -.5, 15)
+    elif ratio_config == 'smart sharpe':
+        ratio = metrics['smart_sharpe']
+        ratio_normalized = jh.normalize(ratio, -.5, 5)
+    elif ratio_config == 'smart sortino':
+        ratio = metrics['smart_sortino']
+        ratio_normalized = jh.normalize(ratio, -.5, 15)
+    else:
+        raise ValueError(
+            f'The entered ratio configuration `{ratio_config}` for the optimization is unknown. Choose between sharpe, calmar, sortino, serenity, smart shapre, smart sortino and omega.')
+
+    return total_effect_rate * ratio_normalized, ratio
+
+
+def get_pruning_checkpoints(cfg) -> list:
+    """
+    the end dates of the interim training backtests, from the pruning_checkpoints
+    fractions of the training timespan
+    """
+    day = 24 * 60 * 60 * 1000
+    start = jh.date_to_timestamp(cfg['timespan-train']['start_date'])
+    finish = jh.date_to_timestamp(cfg['timespan-train']['finish_date'])
+    checkpoints = []
+    for fraction in sorted(cfg.get('pruning_checkpoints') or []):
+        checkpoint = start + int((finish - start) * fraction) // day * day
+        if start < checkpoint < finish and jh.timestamp_to_date(checkpoint) not in checkpoints:
+            checkpoints.append(jh.timestamp_to_date(checkpoint))
+    return checkpoints
+
+
+def prune_training(trial, cfg, result_sink) -> None:
+    """
+    backtests the training timespan until every checkpoint and reports the interim score
+    to the pruner. jesse's backtest can't report from inside a run, so each checkpoint is
+    a backtest of the beginning of the training timespan. Raises optuna.TrialPruned for
+    hopeless parameters before the full training backtest runs, their result row has the
+    interim training metrics and no score.
+    """
+    for step, checkpoint in enumerate(get_pruning_checkpoints(cfg), start=1):
+        try:
+            metrics = backtest_function(cfg['timespan-train']['start_date'], checkpoint, trial.params, cfg)
+        except Exception as err:
+            logger.error("".join(traceback.TracebackException.from_exception(err).format()))
+            raise err
+
+        if metrics is None or metrics['total'] == 0:
+            continue
+        reason = None
+        if metrics['max_drawdown'] < MAX_TRAINING_DRAWDOWN:
+            # the drawdown of the whole training timespan can't be smaller
+            reason = f'max drawdown {metrics["max_drawdown"]} until {checkpoint}'
+        else:
+            trial.report(get_score(metrics, cfg)[0], step)
+            if trial.should_prune():
+                reason = f'pruned at {checkpoint}'
+        if reason is not None:
+            result_sink.write_result(trial.params, np.nan, training_data_metrics=metrics, testing_data_metrics=None,
+                                     trial_number=trial.number)
+            raise optuna.TrialPruned(reason)
+
+
+def get_backtest_candles(cfg, start_date, finish_date):
+    """
+    builds the candles dict and extra routes for jesse's backtest. The candle arrays are
+    views into the cached superset of each symbol, so building the dict is cheap. It has
+    to be rebuilt for every backtest because jesse replaces the arrays inside the dict.
+    """
+    candles = {}
+    extra_routes = []
+    if (cfg['extra_routes']) is not None:
+        for extra_route in cfg['extra_routes'].items():
+            extra_route = extra_route[1]
+            candles[jh.key(extra_route['exchange'], extra_route['symbol'])] = {
+                'exchange': extra_route['exchange'],
+                'symbol': extra_route['symbol'],
+                'candles': get_candles_with_cache(
+                    extra_route['exchange'],
+                    extra_route['symbol'],
+                    start_date,
+                    finish_date,
+                    cfg.get('candle_cache_max_size_mb'),
+                ),
+            }
+            extra_routes.append({'exchange': extra_route['exchange'], 'symbol': extra_route['symbol'],
+                                 'timeframe': extra_route['timeframe']})
+    candles[jh.key(cfg['exchange'], cfg['symbol'])] = {
+        'exchange': cfg['exchange'],
+        'symbol': cfg['symbol'],
+        'candles': get_candles_with_cache(
+            cfg['exchange'],
+            cfg['symbol'],
+            start_date,
+            finish_date,
+            cfg.get('candle_cache_max_size_mb'),
+        ),
+    }
+    return candles, extra_routes
+
+
+def backtest_function(start_date, finish_date, hp, cfg):
+    """
+    returns the metrics of a backtest. With memoize enabled, parameters that were
+    already backtested in the same timespan are answered from the memo.
+    """
+    if not cfg.get('memoize', True):
+        return run_backtest(start_date, finish_date, hp, cfg)
+
+    memo = get_memo(cfg.get('memo_max_size_mb'))
+    key = get_memo_key(start_date, finish_date, hp, cfg)
+    backtest_data = memo.get(key)
+    if backtest_data is None:
+        backtest_data = run_backtest(start_date, finish_date, hp, cfg)
+        memo.put(key, backtest_data)
+    return backtest_data
+
+
+def run_backtest(start_date, finish_date, hp, cfg):
+    candles, extra_routes = get_backtest_candles(cfg, start_date, finish_date)
+
+    route = [{'exchange': cfg['exchange'], 'strategy': cfg['strategy_name'], 'symbol': cfg['symbol'],
+              'timeframe': cfg['timeframe']}]
+
+    config = {
+        'starting_balance': cfg['starting_balance'],
+        'fee': cfg['fee'],
+        'futures_leverage': cfg['futures_leverage'],
+        'futures_leverage_mode': cfg['futures_leverage_mode'],
+        'exchange': cfg['exchange'],
+        'settlement_currency': cfg['settlement_currency'],
+        'warm_up_candles': cfg['warm_up_candles'],
+    }
+
+    backtest_data_dict = backtest(config, route, extra_routes, candles, hyperparameters=dict(hp))
+    backtest_data = dict(backtest_data_dict['metrics'])
+    del backtest_data_dict
+    del candles
+    del route
+    del extra_routes
+    del config
+
+    if backtest_data['total'] == 0:
+        backtest_data = dict(empty_backtest_data)
+
+    return backtest_data
+
+def print_best_params(study):
+    print("Number of finished trials: ", len(study.trials))
+
+    trials = sorted(study.best_trials, key=lambda t: t.values)
+
+    for trial in trials:
+        print(f"Trial #{trial.number} Values: { trial.values} {trial.params}")
+
+
+def save_best_params(study, study_name: str):
+    with open("results.txt", "a") as f:
+        f.write(f"{study_name} Number of finished trials: {len(study.trials)}\n")
+
+        trials = sorted(study.best_trials, key=lambda t: t.values)
+
+        for trial in trials:
+            f.write(
+                f"Trial: {trial.number} Values: {trial.values} Params: {trial.params}\n") 
+
+
+def load_testing_dnas(cfg, hp_names):
+    """
+    loads the results with testing trades and a testing win rate above 0.85.
+    From parquet only the needed columns are read and the filters (including
+    the drawdown cutoff) are pushed down to the files.
+    """
+    if cfg.get('results_format') != 'parquet':
+        path = get_csv_path(cfg)
+        print("get the best candidates from", path)
+        testresults = pd.read_csv(path, sep='\t', lineterminator='\n')
+        testing_dnas = testresults[testresults['testing_total'] > 0]
+        return testing_dnas[testing_dnas['testing_win_rate'] > 0.85]
+
+    import pyarrow.dataset as ds
+
+    path = get_results_path(cfg)
+    print("get the best candidates from", path)
+    columns = list(hp_names) + ['trial_number', 'testing_total', 'testing_win_rate', 'testing_net_profit',
+                                'testing_gross_loss', 'testing_largest_losing_trade', 'testing_longs_count',
+                                'testing_calmar_ratio']
+    # testing_largest_losing_trade > -50 is the "drawdown > -5%" cutoff of get_best_candidates
+    row_filter = (ds.field('testing_total') > 0) & (ds.field('testing_win_rate') > 0.85) & \
+                 (ds.field('testing_largest_losing_trade') > -50)
+    return read_results(path, columns=columns, filter=row_filter).set_index('trial_number')
+
+
+def get_best_candidates(cfg, pool=None): 
+    study_name = get_study_name(cfg)
+
+    # get all used parameters in this strategy
+    StrategyClass = jh.get_strategy_class(cfg['strategy_name'])
+    hp_dict = StrategyClass().hyperparameters()
+
+    testing_dnas = load_testing_dnas(cfg, [hp['name'] for hp in hp_dict])
+    
+    # calculate real profit
+    testing_dnas['testing_real_net_profit_percentage'] = testing_dnas.testing_net_profit / 1000.0 * 100
+    #calculate the real cumulated drawdown
+    testing_dnas['testing_gross_drawdown'] = testing_dnas.testing_gross_loss / 1000.0 * 100
+    #calculate the real drawdown
+    testing_dnas['testing_real_max_drawdown'] = testing_dnas.testing_largest_losing_trade / 1000.0 * 100
+
+    # calculate 
+    testing_dnas['my_ratio'] = -(testing_dnas.testing_real_max_drawdown*testing_dnas.testing_real_max_drawdown) / (testing_dnas.testing_real_net_profit_percentage*testing_dnas.testing_real_net_profit_percentage) \
+                                * testing_dnas.testing_longs_count * testing_dnas.testing_calmar_ratio
+
+    testing_dnas['my_ratio2'] = testing_dnas.testing_real_net_profit_percentage - (testing_dnas.testing_real_max_drawdown*testing_dnas.testing_real_max_drawdown) + 3*testing_dnas.testing_gross_drawdown \
+                                * testing_dnas.testing_longs_count **(1/5) * testing_dnas.testing_win_rate
+
+    # filter dnas with a drawdown > 5% 
+    testing_dnas = testing_dnas[testing_dnas['testing_real_max_drawdown'] > -5]
+
+    #testing_dnas = testing_dnas.sort_values(by=['testing_net_profit'], ascending=False)
+    testing_dnas = testing_dnas.sort_values(by=['my_ratio2'], ascending=False)
+
+    path_csv_best_candidates = 'storage/jesse-optuna/csv/best_candidates'
+    os.makedirs(path_csv_best_candidates, exist_ok=True)
+    path = f'{path_csv_best_candidates}/{study_name}_widerange.csv'
+    if "id" in cfg:
+        path_csv_best_candidates = 'storage/jesse-optuna/csv/best_candidates/detail'
+        os.makedirs(path_csv_best_candidates, exist_ok=True)
+        path = f'{path_csv_best_candidates}/{study_name}_{cfg["id"]}.csv'
+    if cfg.get('results_format') == 'parquet':
+        import pyarrow.dataset as ds
+
+        # the candidates csv gets all metrics, but only of the selected rows
+        full_rows = read_results(get_results_path(cfg),
+                                 filter=ds.field('trial_number').isin(list(testing_dnas.index))).set_index('trial_number')
+        full_rows = full_rows.drop(columns=[c for c in full_rows.columns if c in testing_dnas.columns or c == 'symbol'])
+        testing_dnas.join(full_rows).to_csv(path, sep='\t', na_rep='nan', line_terminator='\n')
+    else:
+        testing_dnas.to_csv(path, sep='\t', na_rep='nan', line_terminator='\n')
+
+    hps = [hp['name'] for hp in hp_dict]
+    for param in ['testing_real_net_profit_percentage', 'testing_gross_drawdown', 'testing_real_max_drawdown', 'my_ratio2']:
+        hps.append(param)
+
+    best_dnas_dict = {}
+    if not "id" in cfg:
+        # save the best 5 results in a json file: 
+        # read the existing file if it exitsts:
+        path_best_dnas = f'optuna_best_dnas.json'
+        if os.path.isfile(path_best_dnas):
+            try:
+                with open(path_best_dnas, 'r', encoding='UTF-8') as best_dnas_file: 
+                    best_dnas_dict = json.load(best_dnas_file)
+            except json.JSONDecodeError: 
+                raise (
+                'Best DNAs file is formatted wrong.'
+                )
+            except:
+                raise
+
+    best_dnas = {}
+    #check if there enough dnas
+    dna_count = 5 if testing_dnas.shape[0] >=5 else testing_dnas.shape[0]
+    if dna_count == 0: 
+        print("Backtest has no results.")
+        return
+    for i in range(dna_count):
+        res_row = testing_dnas.iloc[[i]]
+        dna_list = {'id': int(res_row.index[0])}
+        for hp in hps:
+            dna_list[hp] = res_row.iloc[0][hp]
+        best_dnas[dna_list['id']]  = dna_list
+    
+    best_dnas_dict[cfg['symbol']] = best_dnas
+
+    if not "id" in cfg:
+        # only save the best candidates in a json file if we are in a widerange search
+        with open(path_best_dnas, 'w', encoding='UTF-8') as best_dnas_file: 
+            json.dump(best_dnas_dict, best_dnas_file)
+
+    if not "id" in cfg:
+        create_charts(best_dnas, path_csv_best_candidates, study_name, cfg=cfg, pool=pool)
+    else:
+        create_charts(best_dnas, path_csv_best_candidates, study_name, cfg["id"], cfg=cfg, pool=pool)
+
+def create_charts(best_dnas, path_csv_best_candidates, study_name, detail_id=None, cfg=None, pool=None):
+    """
+    creates the charts of the best candidates. With a pool every chart is rendered by
+    its own worker, so a symbol's charts take about as long as the slowest one.
+    """
+    if cfg is None:
+        cfg = get_config(run=True)
+    # fills the candle superset once, the workers memory map the same file
+    get_backtest_candles(cfg, cfg['timespan-testing']['start_date'], cfg['timespan-testing']['finish_date'])
+
+    jobs = []
+    for dna in best_dnas:
+        path = f'{path_csv_best_candidates}/{study_name}_{dna}.png'
+        if detail_id is not None:
+            path = f'{path_csv_best_candidates}/{study_name}_{detail_id}_{dna}.png'
+        jobs.append((dna, (cfg, dict(best_dnas[dna]), path)))
+
+    if pool is None:
+        for dna, args in jobs:
+            print("Create the Chart for id", dna)
+            render_chart(*args)
+        return
+
+    print("Create the Charts for ids", [dna for dna, _ in jobs])
+    futures = [(dna, pool.submit(render_chart, *args)) for dna, args in jobs]
+    for dna, future in futures:
+        try:
+            future.result()
+        except Exception as err:
+            print(f"Chart for id {dna} failed: {err}")
+
+
+def render_chart(cfg, hp, path) -> None:
+    """
+    runs the testing backtest of hp with charts and moves the chart to path
+    """
+    # headless rendering, workers have no display
+    import matplotlib
+    matplotlib.use('Agg')
+
+    if cfg.get('fast_warmup', True):
+        install_fast_warmup()
+    candles, extra_routes = get_backtest_candles(cfg, cfg['timespan-testing']['start_date'],
+                                                 cfg['timespan-testing']['finish_date'])
+
+    route = [{'exchange': cfg['exchange'], 'strategy': cfg['strategy_name'], 'symbol': cfg['symbol'],
+              'timeframe': cfg['timeframe']}]
+
+    config = {
+        'starting_balance': cfg['starting_balance'],
+        'fee': cfg['fee'],
+        'futures_leverage': cfg['futures_leverage'],
+        'futures_leverage_mode': cfg['futures_leverage_mode'],
+        'exchange': cfg['exchange'],
+        'settlement_currency': cfg['settlement_currency'],
+        'warm_up_candles': cfg['warm_up_candles'],
+    }
+    # jesse names the chart in storage/charts after the session id, which is a new uuid for
+    # every backtest, so charts rendered at the same time don't overwrite each other. It is
+    # moved right away to keep storage/charts from filling up.
+    backtest_data_dict = backtest(config, route, extra_routes, candles, generate_charts=True,
+                                  hyperparameters=hp)
+    if backtest_data_dict.get("charts"):
+        shutil.move(backtest_data_dict["charts"], path)
@@ -0,0 +1,175 @@
+import atexit
+import csv
+import io
+import os
+import pathlib
+import tempfile
+import time
+
+from .file_lock import file_lock
+
+empty_backtest_data = {'total': 0, 'total_winning_trades': None, 'total_losing_trades': None,
+                       'starting_balance': None, 'finishing_balance': None, 'win_rate': None,
+                       'ratio_avg_win_loss': None, 'longs_count': None, 'longs_percentage': None,
+                       'shorts_percentage': None, 'shorts_count': None, 'fee': None, 'net_profit': None,
+                       'net_profit_percentage': None, 'average_win': None, 'average_loss': None, 'expectancy': None,
+                       'expectancy_percentage': None, 'expected_net_profit_every_100_trades': None,
+                       'average_holding_period': None, 'average_winning_holding_period': None,
+                       'average_losing_holding_period': None, 'gross_profit': None, 'gross_loss': None,
+                       'max_drawdown': None, 'annual_return': None, 'sharpe_ratio': None, 'calmar_ratio': None,
+                       'sortino_ratio': None, 'omega_ratio': None, 'serenity_index': None, 'smart_sharpe': None,
+                       'smart_sortino': None, 'total_open_trades': None, 'open_pl': None, 'winning_streak': None,
+                       'losing_streak': None, 'largest_losing_trade': None, 'largest_winning_trade': None,
+                       'current_streak': None}
+
+# sinks of this process that may still hold buffered rows
+_sinks = []
+
+
+def get_result_columns(hp_dict) -> list:
+    """
+    the fixed column order of the study csv
+    """
+    return [hp['name'] for hp in hp_dict] + ["score"] + [f'training_{k}' for k in empty_backtest_data.keys()] + \
+           [f'testing_{k}' for k in empty_backtest_data.keys()]
+
+
+class ResultSink:
+    """
+    buffers the result rows of one worker and appends them to the study csv in
+    batches. Every batch is written with a single append while holding a lock
+    file, so rows of concurrent workers never interleave.
+    """
+    def __init__(self, path: str, columns: list, buffer_size: int = 50, flush_interval: float = 30):
+        self.path = path
+        self.columns = columns
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self._rows = []
+        self._last_flush = time.time()
+        _sinks.append(self)
+
+    def write_result(self, parameters, score, training_data_metrics, testing_data_metrics, trial_number=None) -> None:
+        row = dict(parameters)
+        row["trial_number"] = trial_number
+        row["score"] = score
+        for key, value in training_data_metrics.items():
+            row[f'training_{key}'] = value
+        if testing_data_metrics is not None:
+            for key, value in testing_data_metrics.items():
+                row[f'testing_{key}'] = value
+
+        self._rows.append([row.get(column) for column in self.columns])
+        if len(self._rows) >= self.buffer_size or time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        self._last_flush = time.time()
+        if not self._rows:
+            return
+        self._write_rows()
+        self._rows = []
+
+    def _write_rows(self) -> None:
+        buffer = io.StringIO()
+        csv.writer(buffer, delimiter='\t', lineterminator='\n').writerows(self._rows)
+        data = buffer.getvalue().encode()
+
+        with file_lock(f'{self.path}.lock'):
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                while data:
+                    data = data[os.write(fd, data):]
+            finally:
+                os.close(fd)
+
+    def close(self) -> None:
+        self.flush()
+        if self in _sinks:
+            _sinks.remove(self)
+
+
+class ParquetResultSink(ResultSink):
+    """
+    writes every batch as a typed parquet file into a dataset partitioned by study
+    and symbol (results/study=.../symbol=.../part-*.parquet). Readers can then load
+    only the columns they need and push filters down to the files.
+    """
+    def __init__(self, path: str, hp_dict, symbol: str, buffer_size: int = 50, flush_interval: float = 30):
+        import pyarrow as pa
+
+        self.directory = pathlib.Path(path) / f'symbol={symbol}'
+        self.directory.mkdir(parents=True, exist_ok=True)
+        types = {int: pa.int64(), float: pa.float64(), bool: pa.bool_()}
+        fields = [pa.field(hp['name'], types[hp['type']]) for hp in hp_dict] + [
+            pa.field('trial_number', pa.int64()), pa.field('score', pa.float64())] + [
+            pa.field(f'{prefix}_{k}', pa.float64()) for prefix in ('training', 'testing') for k in empty_backtest_data]
+        self.schema = pa.schema(fields)
+        super().__init__(path, self.schema.names, buffer_size, flush_interval)
+
+    def _write_rows(self) -> None:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        columns = list(zip(*self._rows))
+        table = pa.Table.from_arrays(
+            [pa.array([_to_python(v) for v in column], type=field.type) for column, field in zip(columns, self.schema)],
+            schema=self.schema)
+        # dot files are ignored by dataset readers until the part is complete
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.part-', suffix='.tmp')
+        os.close(fd)
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, self.directory / f'part-{os.getpid()}-{time.time_ns()}.parquet')
+
+
+def _to_python(value):
+    # numpy scalars and nan from the metrics
+    if value is None:
+        return None
+    if hasattr(value, 'item'):
+        value = value.item()
+    if isinstance(value, float) and value != value:
+        return None
+    return value
+
+
+def read_results(path: str, columns=None, filter=None):
+    """
+    reads a parquet results dataset of a study into a pandas DataFrame
+    """
+    import pyarrow.dataset as ds
+
+    dataset = ds.dataset(path, format='parquet', partitioning='hive')
+    return dataset.to_table(columns=columns, filter=filter).to_pandas()
+
+
+def compact_results(path: str) -> None:
+    """
+    merges the part files every flush of every worker wrote into one file per partition,
+    called once the study is finished
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    for directory in pathlib.Path(path).glob('symbol=*'):
+        parts = sorted(directory.glob('part-*.parquet'))
+        if len(parts) < 2:
+            continue
+        table = pa.concat_tables([pq.ParquetFile(part).read() for part in parts])
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.part-', suffix='.tmp')
+        os.close(fd)
+        pq.write_table(table, tmp_path)
+        for part in parts:
+            part.unlink()
+        os.replace(tmp_path, directory / f'part-{os.getpid()}-{time.time_ns()}.parquet')
+
+
+def flush_results() -> None:
+    """
+    writes the buffered rows of all sinks of this process
+    """
+    for sink in _sinks:
+        sink.flush()
+
+
+atexit.register(flush_results)
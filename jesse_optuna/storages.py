@@ -0,0 +1,191 @@
+import os
+import sqlite3
+
+import optuna
+import sqlalchemy
+
+STORAGES = ('postgres', 'sqlite', 'journal')
+SQLITE_PATH = 'storage/jesse-optuna/optuna.sqlite'
+JOURNAL_PATH = 'storage/jesse-optuna/optuna.journal'
+
+# storage key -> (pid, storage) of this process, reused by every study a worker runs
+_storages = {}
+# sql statements sent by the storages of this process and trials they finished
+_round_trips = 0
+_finished_trials = 0
+
+
+def get_postgres_url(cfg) -> str:
+    return f"postgresql://{cfg['postgres_username']}:{cfg['postgres_password']}@{cfg['postgres_host']}:" \
+           f"{cfg['postgres_port']}/{cfg['postgres_db_name']}"
+
+
+def get_storage_key(cfg) -> tuple:
+    name = cfg.get('storage') or 'postgres'
+    if name == 'postgres':
+        return name, get_postgres_url(cfg), cfg.get('storage_pool_size') or 2, cfg.get('storage_max_overflow') or 2
+    if name == 'sqlite':
+        return name, cfg.get('storage_path') or SQLITE_PATH
+    if name == 'journal':
+        return name, cfg.get('storage_path') or JOURNAL_PATH
+    raise ValueError(f'The entered storage `{name}` is unknown. Choose between {", ".join(STORAGES)}.')
+
+
+def get_storage(cfg):
+    """
+    the optuna storage selected with `storage` in the config:
+    postgres: RDB storage with a small connection pool per worker process
+    sqlite:   a local SQLite file in WAL mode, readers don't block the writer
+    journal:  optuna's append-only journal file, no database at all (single machine only)
+    Every process creates a storage only once, see _get_process_storage.
+    """
+    return _get_process_storage(get_storage_key(cfg))
+
+
+def _get_process_storage(key: tuple):
+    """
+    the storage of this process for key. Jobs and studies pickle their storage, unpickling
+    returns this one, so a worker keeps its connection pool instead of opening a new one
+    for every study.
+    """
+    cached = _storages.get(key)
+    if cached is not None and cached[0] == os.getpid():
+        return cached[1]
+    if cached is not None and isinstance(cached[1], _CachedStorage):
+        # inherited from the parent by fork, its connections belong to the parent
+        try:
+            cached[1]._backend.engine.dispose(close=False)
+        except TypeError:  # sqlalchemy < 1.4.33
+            pass
+
+    if key[0] == 'postgres':
+        storage = _CachedStorage(key, optuna.storages.RDBStorage(key[1], engine_kwargs={
+            'pool_size': key[2],
+            'max_overflow': key[3],
+            # connections of idle workers may have been dropped by the server
+            'pool_pre_ping': True,
+        }))
+    elif key[0] == 'sqlite':
+        storage = _CachedStorage(key, get_sqlite_storage(key[1]))
+    else:
+        os.makedirs(os.path.dirname(key[1]) or '.', exist_ok=True)
+        storage = _JournalStorage(key, optuna.storages.JournalFileStorage(key[1]))
+    _storages[key] = (os.getpid(), storage)
+    return storage
+
+
+def _count_round_trip(*args) -> None:
+    global _round_trips
+    _round_trips += 1
+
+
+def _reset_round_trips() -> None:
+    global _round_trips, _finished_trials
+    _round_trips = 0
+    _finished_trials = 0
+
+
+# forked workers count their own statements
+os.register_at_fork(after_in_child=_reset_round_trips)
+
+
+def get_round_trips() -> tuple:
+    """
+    (sql statements, finished trials) of the storages of this process
+    """
+    return _round_trips, _finished_trials
+
+
+class _CachedStorage(optuna.storages._CachedStorage):
+    """
+    optuna's cache in front of an RDB storage (what optuna uses for storage urls), so the
+    samplers read finished trials from memory. Pickled as its key, see _get_process_storage.
+    """
+    def __init__(self, key: tuple, backend: optuna.storages.RDBStorage):
+        super().__init__(backend)
+        self.key = key
+        sqlalchemy.event.listen(backend.engine, 'before_cursor_execute', _count_round_trip)
+
+    def __reduce__(self):
+        return _get_process_storage, (self.key,)
+
+    def forget_study(self, study_id: int) -> None:
+        """
+        drops the cached trials of the study, the storage itself outlives it
+        """
+        with self._lock:
+            study = self._studies.pop(study_id, None)
+            if study is None:
+                return
+            for number in study.trials:
+                trial_id = self._study_id_and_number_to_trial_id.pop((study_id, number), None)
+                self._trial_id_to_study_id_and_number.pop(trial_id, None)
+
+    def get_trials_after(self, study_id: int, number: int, numbers) -> list:
+        """
+        trials of the study with a number above number or in numbers, ordered by number.
+        Only their rows are loaded, in one batched query, while get_all_trials reads the
+        ids of all trials of the study and sorts the whole cache on every call.
+        """
+        from optuna.storages._cached_storage import _StudyInfo
+        from optuna.storages._rdb import models
+        from optuna.storages._rdb.storage import _create_scoped_session
+        from sqlalchemy.orm import selectinload
+
+        trial = models.TrialModel
+        with _create_scoped_session(self._backend.scoped_session) as session:
+            trial_models = (session.query(trial)
+                            .options(*[selectinload(relation) for relation in (
+                                trial.params, trial.values, trial.user_attributes, trial.system_attributes,
+                                trial.intermediate_values)])
+                            .filter(trial.study_id == study_id,
+                                    sqlalchemy.or_(trial.number > number, trial.number.in_(list(numbers))))
+                            .order_by(trial.number)
+                            .all())
+            trials = [self._backend._build_frozen_trial_from_trial_model(model) for model in trial_models]
+
+        # keeps the cache of optuna's own reads up to date
+        with self._lock:
+            study = self._studies.setdefault(study_id, _StudyInfo())
+            self._add_trials_to_cache(study_id, trials)
+            study.finished_trial_ids.update(t._trial_id for t in trials if t.state.is_finished())
+        return trials
+
+    def set_trial_state_values(self, trial_id, state, values=None) -> bool:
+        global _finished_trials
+        changed = super().set_trial_state_values(trial_id, state, values)
+        if state.is_finished():
+            _finished_trials += 1
+        return changed
+
+
+class _JournalStorage(optuna.storages.JournalStorage):
+    """
+    a journal storage replays the whole log when it is created, workers reuse theirs
+    """
+    def __init__(self, key: tuple, backend):
+        super().__init__(backend)
+        self.key = key
+
+    def __reduce__(self):
+        return _get_process_storage, (self.key,)
+
+
+def release_study(study) -> None:
+    """
+    called by a worker once it ran its last trial of the study. The cache of its reused
+    storage would otherwise keep the trials of every study of a batch in memory.
+    """
+    storage = study._storage
+    if isinstance(storage, _CachedStorage):
+        storage.forget_study(study._study_id)
+
+
+def get_sqlite_storage(path: str) -> optuna.storages.RDBStorage:
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    # WAL is a property of the database file, every later connection uses it
+    connection = sqlite3.connect(path)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.close()
+    # wait for the write lock of other workers instead of failing with "database is locked"
+    return optuna.storages.RDBStorage(f'sqlite:///{path}', engine_kwargs={'connect_args': {'timeout': 60}})
@@ -0,0 +1,105 @@
+import hashlib
+import os
+
+import jesse.helpers as jh
+import yaml
+
+from .candledates import install_fast_warmup
+from .config import RUN_CONFIG_PATH
+from .result_sink import ParquetResultSink, ResultSink, get_result_columns
+
+# run config path -> ((mtime_ns, size), TrialContext)
+_contexts = {}
+
+
+def get_study_name(cfg) -> str:
+    return f"{cfg['study_name']}-{cfg['strategy_name']}-{cfg['exchange']}-{cfg['symbol']}-{cfg['timeframe']}"
+
+
+def get_csv_path(cfg) -> str:
+    study_name = get_study_name(cfg)
+    if 'id' in cfg:
+        return f'storage/jesse-optuna/csv/best_candidates/detail/{study_name}_{cfg["id"]}.csv'
+    return f'storage/jesse-optuna/csv/{study_name}.csv'
+
+
+def get_results_path(cfg) -> str:
+    """
+    parquet dataset of a study's trial results, used with results_format: parquet
+    """
+    if 'id' in cfg:
+        return f'storage/jesse-optuna/results/study={get_study_name(cfg)}_{cfg["id"]}'
+    return f'storage/jesse-optuna/results/study={get_study_name(cfg)}'
+
+
+def get_run_config_path(cfg) -> str:
+    """
+    run config of a single study, used when several studies run at the same time
+    """
+    if 'id' in cfg:
+        return f'storage/jesse-optuna/run/{get_study_name(cfg)}_{cfg["id"]}.yml'
+    return f'storage/jesse-optuna/run/{get_study_name(cfg)}.yml'
+
+
+class TrialContext:
+    """
+    everything objective() needs that only changes together with the run config.
+    built once per worker process and reused for every trial of the study.
+    """
+    def __init__(self, cfg, config_hash: str):
+        self.cfg = cfg
+        self.config_hash = config_hash
+        self.study_name = get_study_name(cfg)
+        self.csv_path = get_csv_path(cfg)
+        self.strategy_class = jh.get_strategy_class(cfg['strategy_name'])
+        self.hp_dict = self.strategy_class().hyperparameters(cfg['symbol'])
+
+        if cfg.get('fast_warmup', True):
+            install_fast_warmup()
+
+        if cfg.get('results_format') == 'parquet':
+            self.result_sink = ParquetResultSink(get_results_path(cfg), self.hp_dict, cfg['symbol'],
+                                                 cfg.get('result_buffer_size') or 50)
+        else:
+            self.result_sink = ResultSink(self.csv_path, get_result_columns(self.hp_dict),
+                                          cfg.get('result_buffer_size') or 50)
+
+        for st_hp in self.hp_dict:
+            if st_hp['type'] is int and 'step' not in st_hp:
+                st_hp['step'] = 1
+            elif st_hp['type'] is float and 'step' not in st_hp:
+                st_hp['step'] = 0.1
+
+
+def get_trial_context(path: str = RUN_CONFIG_PATH) -> TrialContext:
+    """
+    returns the cached context of this process. The run config is only re-read if
+    its mtime changed and only rebuilt if its content hash changed as well.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        print("{} not found. Run create-config command.".format(path))
+        exit()
+
+    signature = (stat.st_mtime_ns, stat.st_size)
+    cached = _contexts.get(path)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    with open(path, 'rb') as ymlfile:
+        raw = ymlfile.read()
+    config_hash = hashlib.sha1(raw).hexdigest()
+
+    if cached is not None and cached[1].config_hash == config_hash:
+        # touched but unchanged
+        _contexts[path] = (signature, cached[1])
+        return cached[1]
+
+    if cached is not None:
+        # write the remaining rows of the previous study
+        cached[1].result_sink.close()
+
+    context = TrialContext(yaml.load(raw, yaml.SafeLoader), config_hash)
+    _contexts[path] = (signature, context)
+    return context
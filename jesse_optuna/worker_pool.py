@@ -0,0 +1,304 @@
+import concurrent.futures
+import importlib
+import multiprocessing
+import os
+import pickle
+import queue
+import threading
+import time
+import traceback
+
+import psutil
+
+
+class WorkerError(RuntimeError):
+    pass
+
+
+# recycling limits and counters of this worker process, set by _worker_loop
+_recycle_after_trials = None
+_recycle_after_growth_mb = None
+_trials = 0
+_baseline_rss_mb = None
+_retire_reason = None
+
+
+def count_trial():
+    """
+    counts a finished trial of this worker. Returns why the worker should be replaced
+    by a fresh process (recycle_after_trials trials or recycle_after_growth_mb rss growth
+    since its first trial) or None. Outside of pool workers there are no limits.
+    """
+    global _trials, _baseline_rss_mb, _retire_reason
+    _trials += 1
+    if _recycle_after_growth_mb is not None:
+        rss = psutil.Process().memory_info().rss / 1024 / 1024
+        if _baseline_rss_mb is None:
+            _baseline_rss_mb = rss
+        elif rss - _baseline_rss_mb > _recycle_after_growth_mb:
+            _retire_reason = f'rss grew {rss - _baseline_rss_mb:.0f} MB'
+    if _recycle_after_trials is not None and _trials >= _recycle_after_trials:
+        _retire_reason = f'{_trials} trials'
+    return _retire_reason
+
+
+def retire(reason: str) -> None:
+    """
+    the worker exits after its current job and the pool starts a fresh process
+    """
+    global _retire_reason
+    _retire_reason = reason
+
+
+def get_retire_reason():
+    return _retire_reason
+
+
+def _probe(barrier, modules, timeout: float) -> dict:
+    """
+    reports how long the worker took from its start until it had imported the modules
+    a job needs and how much memory it uses. uss is the memory only this worker uses,
+    pages shared copy-on-write with the parent aren't counted.
+    """
+    for module in modules:
+        importlib.import_module(module)
+    process = psutil.Process()
+    startup = time.time() - process.create_time()
+    memory = process.memory_full_info()
+    # keep the worker busy until every worker took a probe
+    try:
+        barrier.wait(timeout)
+    except threading.BrokenBarrierError:
+        # a worker took longer to start, it still reports its own probe
+        pass
+    return {'pid': process.pid, 'startup_s': startup, 'rss_mb': memory.rss / 1024 / 1024,
+            'uss_mb': memory.uss / 1024 / 1024}
+
+
+def _worker_loop(tasks, results, current_task, recycle_after_trials=None, recycle_after_growth_mb=None) -> None:
+    global _recycle_after_trials, _recycle_after_growth_mb
+    _recycle_after_trials = recycle_after_trials
+    _recycle_after_growth_mb = recycle_after_growth_mb
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        task_id, payload = task
+        # shared memory is written at once, the 'started' message may still be in the
+        # queue's feeder thread if the worker gets killed
+        current_task.value = task_id
+        results.put(('started', task_id, os.getpid()))
+        try:
+            fn, args, kwargs = pickle.loads(payload)
+            results.put(('done', task_id, fn(*args, **kwargs)))
+        except BaseException as err:
+            results.put(('error', task_id, "".join(traceback.TracebackException.from_exception(err).format())))
+        if _retire_reason is not None:
+            # the pool replaces this process
+            break
+
+
+class WorkerPool:
+    """
+    long lived worker processes that receive jobs (e.g. the trials of a study) one
+    after another. Workers keep their imports, the trial context and the candle maps
+    between jobs, so batch runs don't pay the worker start-up for every study.
+
+    With start_method 'fork' the workers are forked from the current process and
+    share everything it already imported and mapped copy-on-write. 'forkserver'
+    forks them from a clean server process that imported the preload modules once.
+
+    With memory_limit_mb or min_free_memory_mb a monitor thread lowers active_workers
+    while the workers' rss is above the limit or the system runs out of free memory and
+    raises it again once there is room. Jobs of inactive slots retire their worker.
+    Workers are also replaced after recycle_after_trials trials or recycle_after_growth_mb
+    rss growth. All of this is recorded in events.
+    """
+    def __init__(self, n_workers: int = -1, start_method: str = 'spawn', preload=None, memory_limit_mb=None,
+                 min_free_memory_mb=None, recycle_after_trials=None, recycle_after_growth_mb=None,
+                 monitor_interval: float = 5):
+        if n_workers == -1:
+            n_workers = os.cpu_count()
+        self.n_workers = n_workers
+        if start_method not in multiprocessing.get_all_start_methods():
+            # fork and forkserver don't exist on windows
+            print(f"start method {start_method} isn't available on this platform, using spawn")
+            start_method = 'spawn'
+        self.start_method = start_method
+        self.memory_limit_mb = memory_limit_mb
+        self.min_free_memory_mb = min_free_memory_mb
+        self.recycle_after_trials = recycle_after_trials
+        self.recycle_after_growth_mb = recycle_after_growth_mb
+        self.events = []
+        self._ctx = multiprocessing.get_context(start_method)
+        if start_method == 'forkserver' and preload:
+            self._ctx.set_forkserver_preload(list(preload))
+        self.manager = self._ctx.Manager()
+        # number of job slots that may take trials, see JoblilbStudy.TrialBudget
+        self.active_workers = self.manager.Value('i', n_workers)
+        self._tasks = self._ctx.Queue()
+        self._results = self._ctx.Queue()
+        self._lock = threading.Lock()
+        self._futures = {}
+        self._running = {}  # task id -> pid
+        self._next_task_id = 0
+        self._closed = False
+        self._processes = [self._start_worker() for _ in range(n_workers)]
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+        self._stop_monitor = threading.Event()
+        self._monitor_thread = None
+        if memory_limit_mb is not None or min_free_memory_mb is not None:
+            self._monitor_thread = threading.Thread(target=self._monitor, args=(monitor_interval,), daemon=True)
+            self._monitor_thread.start()
+
+    def _start_worker(self):
+        # id of the last task the worker took from the queue
+        current_task = self._ctx.RawValue('q', -1)
+        process = self._ctx.Process(target=_worker_loop, args=(self._tasks, self._results, current_task,
+                                                               self.recycle_after_trials,
+                                                               self.recycle_after_growth_mb), daemon=True)
+        process.start()
+        process.current_task = current_task
+        return process
+
+    def submit(self, fn, *args, **kwargs) -> concurrent.futures.Future:
+        if self._closed:
+            raise RuntimeError('Cannot submit to a closed WorkerPool.')
+        # pickle here, so errors are raised to the caller instead of inside the queue's feeder thread
+        payload = pickle.dumps((fn, args, kwargs), protocol=pickle.HIGHEST_PROTOCOL)
+        future = concurrent.futures.Future()
+        with self._lock:
+            task_id = self._next_task_id
+            self._next_task_id += 1
+            self._futures[task_id] = future
+        self._tasks.put((task_id, payload))
+        return future
+
+    def probe(self, modules=()) -> list:
+        """
+        runs _probe once on every worker and returns their start-up latency and memory
+        """
+        barrier = self.manager.Barrier(self.n_workers)
+        # workers start at the same time, the more of them the longer the last one takes
+        timeout = max(60, 5 * self.n_workers)
+        futures = [self.submit(_probe, barrier, list(modules), timeout) for _ in range(self.n_workers)]
+        return [future.result() for future in futures]
+
+    def record_event(self, event: str, **details) -> None:
+        self.events.append(dict(time=time.time(), event=event, **details))
+
+    def _monitor(self, interval: float) -> None:
+        """
+        scales the active workers down and up against the memory limits, without
+        touching the workers (no forced garbage collection)
+        """
+        while not self._stop_monitor.wait(interval):
+            rss = 0
+            for process in list(self._processes or []):
+                try:
+                    rss += psutil.Process(process.pid).memory_info().rss
+                except (psutil.NoSuchProcess, ValueError):
+                    continue
+            rss_mb = rss / 1024 / 1024
+            available_mb = psutil.virtual_memory().available / 1024 / 1024
+            active = self.active_workers.value
+
+            too_much = (self.memory_limit_mb is not None and rss_mb > self.memory_limit_mb) or \
+                       (self.min_free_memory_mb is not None and available_mb < self.min_free_memory_mb)
+            # room for one more worker of the current average size with some headroom
+            room = (self.memory_limit_mb is None or
+                    rss_mb / max(active, 1) * (active + 1) < self.memory_limit_mb * 0.9) and \
+                   (self.min_free_memory_mb is None or available_mb > self.min_free_memory_mb * 1.5)
+            if too_much and active > 1:
+                self.active_workers.value = active - 1
+                self.record_event('scale_down', active_workers=active - 1, rss_mb=round(rss_mb),
+                                  available_mb=round(available_mb))
+            elif room and not too_much and active < self.n_workers:
+                self.active_workers.value = active + 1
+                self.record_event('scale_up', active_workers=active + 1, rss_mb=round(rss_mb),
+                                  available_mb=round(available_mb))
+
+    def _collect(self) -> None:
+        while not self._closed or self._futures:
+            try:
+                state, task_id, payload = self._results.get(timeout=1)
+            except queue.Empty:
+                self._check_workers()
+                continue
+            except (EOFError, OSError):
+                break
+
+            with self._lock:
+                if state == 'started':
+                    if task_id in self._futures:
+                        self._running[task_id] = payload
+                    continue
+                self._running.pop(task_id, None)
+                future = self._futures.pop(task_id, None)
+            if future is None:
+                # cancelled by terminate()
+                continue
+            if state == 'done':
+                future.set_result(payload)
+            else:
+                future.set_exception(WorkerError(payload))
+
+    def _check_workers(self) -> None:
+        """
+        fails the job of a worker that died (e.g. killed by the OOM killer) and replaces it
+        """
+        for i, process in enumerate(self._processes):
+            if process.is_alive() or self._closed:
+                continue
+            if process.exitcode != 0:
+                self.record_event('worker_died', pid=process.pid, exitcode=process.exitcode)
+            with self._lock:
+                lost = {task_id for task_id, pid in self._running.items() if pid == process.pid}
+                # taken from the queue, but the 'started' message never arrived
+                lost.add(process.current_task.value)
+                for task_id in lost:
+                    self._running.pop(task_id, None)
+                    future = self._futures.pop(task_id, None)
+                    if future is not None:
+                        future.set_exception(
+                            WorkerError(f'Worker {process.pid} died with exit code {process.exitcode}.'))
+            self._processes[i] = self._start_worker()
+
+    def shutdown(self) -> None:
+        """
+        waits for all submitted jobs and stops the workers
+        """
+        if self._processes is None:
+            return
+        self._closed = True
+        self._stop_monitor.set()
+        for _ in self._processes:
+            self._tasks.put(None)
+        for process in self._processes:
+            process.join()
+        self._collector.join()
+        self.manager.shutdown()
+        self._processes = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.terminate()
+        self.shutdown()
+
+    def terminate(self) -> None:
+        """
+        stops all workers without waiting for their jobs
+        """
+        self._closed = True
+        self._stop_monitor.set()
+        for process in self._processes:
+            process.terminate()
+        with self._lock:
+            futures, self._futures = self._futures, {}
+            self._running.clear()
+        for future in futures.values():
+            future.cancel()
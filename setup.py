@@ -7,7 +7,8 @@ DESCRIPTION = "Bulk backtesting for jesse"
 REQUIRED_PACKAGES = [
     'jesse',
     'pyyaml',
-    'optuna',
+    # history_sampler.py and storages.py build on optuna internals, JournalStorage is new in 3.1
+    'optuna>=3.1,<4.0',
     'psutil'
 ]
 
@@ -24,6 +25,8 @@ setup(
     long_description_content_type="text/markdown",
     url="https://github.com/TheTiEr/jesse-optuna",
     install_requires=REQUIRED_PACKAGES,
+    # results_format: parquet
+    extras_require={'parquet': ['pyarrow']},
     entry_points='''
         [console_scripts]
         jesse-optuna=jesse_optuna.__init__:cli
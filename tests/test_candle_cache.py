@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('jesse')
+
+import jesse.helpers as jh  # noqa: E402
+
+from jesse_optuna import candle_cache  # noqa: E402
+from jesse_optuna.candle_cache import get_candles_fingerprint, get_candles_with_cache  # noqa: E402
+
+
+@pytest.fixture
+def fetched(tmp_path, monkeypatch):
+    fetched = []
+
+    def get_candles(exchange, symbol, timeframe, start_date, finish_date):
+        fetched.append((start_date, finish_date))
+        timestamps = np.arange(jh.date_to_timestamp(start_date), jh.date_to_timestamp(finish_date), 60_000)
+        candles = np.ones((len(timestamps), 6))
+        candles[:, 0] = timestamps
+        return candles
+
+    monkeypatch.setattr(candle_cache, 'get_candles', get_candles)
+    monkeypatch.setattr(candle_cache, 'CACHE_DIR', tmp_path)
+    monkeypatch.setattr(candle_cache, 'NPY_DIR', tmp_path / 'candles')
+    monkeypatch.setattr(candle_cache, '_mapped', {})
+    monkeypatch.setattr(candle_cache, '_fingerprints', {})
+    return fetched
+
+
+def check_window(candles, start_date, finish_date):
+    start, finish = jh.date_to_timestamp(start_date), jh.date_to_timestamp(finish_date)
+    assert len(candles) == (finish - start) // 60_000
+    assert candles[0, 0] == start and candles[-1, 0] == finish - 60_000
+
+
+def test_windows_are_views_into_the_superset(fetched):
+    training = get_candles_with_cache('Binance', 'BTC-USDT', '2021-01-01', '2021-01-05')
+    testing = get_candles_with_cache('Binance', 'BTC-USDT', '2021-01-03', '2021-01-04')
+
+    assert fetched == [('2021-01-01', '2021-01-05')]
+    check_window(training, '2021-01-01', '2021-01-05')
+    check_window(testing, '2021-01-03', '2021-01-04')
+    assert np.shares_memory(training, testing)
+
+
+def test_the_superset_grows_by_the_missing_candles_only(fetched):
+    get_candles_with_cache('Binance', 'BTC-USDT', '2021-01-03', '2021-01-05')
+    later = get_candles_with_cache('Binance', 'BTC-USDT', '2021-01-04', '2021-01-07')
+    wider = get_candles_with_cache('Binance', 'BTC-USDT', '2021-01-01', '2021-01-07')
+
+    assert fetched == [('2021-01-03', '2021-01-05'), ('2021-01-05', '2021-01-07'), ('2021-01-01', '2021-01-03')]
+    check_window(later, '2021-01-04', '2021-01-07')
+    check_window(wider, '2021-01-01', '2021-01-07')
+    assert (np.diff(wider[:, 0]) == 60_000).all()
+
+
+def test_other_processes_map_the_saved_superset(fetched):
+    first = get_candles_with_cache('Binance', 'BTC-USDT', '2021-01-01', '2021-01-05')
+    fingerprint = get_candles_fingerprint('Binance', 'BTC-USDT', '2021-01-02', '2021-01-03')
+    candle_cache._mapped.clear()
+    candle_cache._fingerprints.clear()
+
+    again = get_candles_with_cache('Binance', 'BTC-USDT', '2021-01-02', '2021-01-03')
+    assert fetched == [('2021-01-01', '2021-01-05')]
+    assert not np.shares_memory(first, again)
+    check_window(again, '2021-01-02', '2021-01-03')
+    assert get_candles_fingerprint('Binance', 'BTC-USDT', '2021-01-02', '2021-01-03') == fingerprint
@@ -0,0 +1,97 @@
+import pickle
+
+import optuna
+import pytest
+
+from jesse_optuna import grid
+from jesse_optuna.grid import StreamingGridSampler, decode_grid_index, release_grid_chunks
+
+HPS = [{'name': 'fast', 'type': int, 'min': 1, 'max': 5},
+       {'name': 'slow', 'type': float, 'min': 0.1, 'max': 0.2, 'step': 0.1}]
+
+
+@pytest.fixture(autouse=True)
+def grid_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(grid, 'GRID_DIR', tmp_path)
+    yield tmp_path
+    release_grid_chunks()
+
+
+def new_sampler(chunk_size=4):
+    return StreamingGridSampler(HPS, 'study', chunk_size=chunk_size)
+
+
+def take(sampler, count):
+    return [sampler._next_index() for _ in range(count)]
+
+
+def test_decode_grid_index_covers_every_point():
+    sampler = new_sampler()
+    points = {tuple(decode_grid_index(sampler.dimensions, index).items()) for index in range(sampler.size)}
+    assert sampler.size == 10
+    assert len(points) == 10
+    assert decode_grid_index(sampler.dimensions, 9) == {'fast': 5, 'slow': 0.2}
+
+
+def test_jobs_claim_separate_chunks():
+    sampler = new_sampler()
+    first, second = sampler, pickle.loads(pickle.dumps(sampler))
+    assert take(first, 2) == [0, 1]
+    assert take(second, 5) == [4, 5, 6, 7, 8]
+    assert take(first, 3) == [2, 3, None]
+    assert take(second, 2) == [9, None]
+
+
+def test_release_hands_the_rest_of_the_chunk_back():
+    sampler = new_sampler()
+    first, second = pickle.loads(pickle.dumps(sampler)), pickle.loads(pickle.dumps(sampler))
+    assert take(first, 1) == [0]
+    assert take(second, 1) == [4]
+    release_grid_chunks()
+    assert sampler.get_remaining() == 8
+
+    # a resubmitted job of the same run picks up the handed back points before new ones
+    job = pickle.loads(pickle.dumps(sampler))
+    assert take(job, 8) == [1, 2, 3, 5, 6, 7, 8, 9]
+    assert job._next_index() is None
+
+
+def test_a_job_that_ended_without_release_is_reclaimed():
+    sampler = new_sampler()
+    crashed = pickle.loads(pickle.dumps(sampler))
+    assert take(crashed, 2) == [0, 1]
+    grid._claiming.clear()
+
+    job = pickle.loads(pickle.dumps(sampler))
+    assert take(job, 5) == [0, 1, 2, 3, 4]
+
+
+def test_resume_skips_sampled_points_and_reruns_unfinished_chunks():
+    first_run = new_sampler()
+    assert take(first_run, 2) == [0, 1]
+    release_grid_chunks()
+    assert take(first_run, 3) == [2, 3, 4]
+    grid._claiming.clear()  # the run was killed while sampling 5
+
+    second_run = new_sampler()
+    assert second_run.get_remaining() == 6
+    assert take(second_run, 7) == [4, 5, 6, 7, 8, 9, None]
+
+
+def test_reset_starts_over():
+    sampler = new_sampler()
+    take(sampler, 3)
+    sampler.reset()
+    assert new_sampler().get_remaining() == 10
+
+
+def test_study_samples_every_point_once_and_stops():
+    sampler = new_sampler(chunk_size=3)
+    study = optuna.create_study(sampler=sampler)
+    study.optimize(lambda trial: trial.suggest_int('fast', 1, 5) + trial.suggest_float('slow', 0.1, 0.2),
+                   n_trials=15)
+    complete = study.get_trials(states=(optuna.trial.TrialState.COMPLETE,))
+    assert sorted((t.params['fast'], t.params['slow']) for t in complete) == sorted(
+        (p['fast'], p['slow']) for p in (decode_grid_index(sampler.dimensions, i) for i in range(10)))
+    assert len(study.trials) == 11
+    assert study.trials[-1].state == optuna.trial.TrialState.PRUNED
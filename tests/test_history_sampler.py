@@ -0,0 +1,61 @@
+import optuna
+import pytest
+
+from jesse_optuna.history_sampler import HistoryCachedSampler
+from jesse_optuna.storages import _get_process_storage
+
+
+def objective(trial):
+    return (trial.suggest_float('x', -5, 5) - 1) ** 2 + trial.suggest_int('y', 0, 10)
+
+
+@pytest.fixture
+def storage(tmp_path):
+    return _get_process_storage(('sqlite', str(tmp_path / 'optuna.sqlite')))
+
+
+@pytest.mark.parametrize('sampler_class', [optuna.samplers.TPESampler, optuna.samplers.NSGAIISampler])
+def test_samples_like_the_wrapped_sampler(storage, sampler_class):
+    plain = optuna.create_study(sampler=sampler_class(seed=0))
+    plain.optimize(objective, n_trials=30)
+    cached = optuna.create_study(storage=storage, sampler=HistoryCachedSampler(sampler_class(seed=0)))
+    cached.optimize(objective, n_trials=30)
+    assert [t.params for t in cached.trials] == [t.params for t in plain.trials]
+
+
+def test_sync_only_reads_new_and_unfinished_trials(storage):
+    sampler = HistoryCachedSampler(optuna.samplers.RandomSampler(seed=0))
+    study = optuna.create_study(storage=storage, sampler=sampler)
+    fetched = []
+    get_trials_after = storage.get_trials_after
+
+    def record(study_id, number, numbers):
+        trials = get_trials_after(study_id, number, numbers)
+        fetched.append(sorted(t.number for t in trials))
+        return trials
+
+    storage.get_trials_after = record
+    try:
+        running = study.ask()
+        study.optimize(objective, n_trials=5)
+        study.tell(running, 1.0)
+        study.optimize(objective, n_trials=1)
+    finally:
+        del storage.get_trials_after
+
+    # every sync reads the trial being sampled, the one sampled before it and trial 0 while it runs
+    assert fetched == [[0], [0, 1], [0, 1, 2], [0, 2, 3], [0, 3, 4], [0, 4, 5], [0, 5, 6]]
+    assert [t.number for t in sampler.get_trials(study)] == [0, 1, 2, 3, 4, 5, 6]
+    assert sampler._unfinished == {}
+
+
+def test_history_size_keeps_the_best_and_the_latest(storage):
+    sampler = HistoryCachedSampler(optuna.samplers.RandomSampler(seed=0), history_size=10)
+    study = optuna.create_study(storage=storage, sampler=sampler)
+    for value in [5, 0, 7, 8, 9, 1, 6, 2, 3, 4, 10, 11, 12, 13, 14, 15, 16]:
+        study.enqueue_trial({'x': 0.0, 'y': 0})
+        study.optimize(lambda trial, value=value: objective(trial) * 0 + value, n_trials=1)
+    sampler.sync(study)
+
+    history = sampler.get_trials(study, states=(optuna.trial.TrialState.COMPLETE,))
+    assert [t.number for t in history] == [1] + list(range(7, 17))
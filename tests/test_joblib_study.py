@@ -0,0 +1,82 @@
+import concurrent.futures
+
+import optuna
+import pytest
+
+from jesse_optuna.JoblilbStudy import JoblibStudy, _MAX_JOB_FAILURES, _run_jobs
+from jesse_optuna.worker_pool import WorkerError, WorkerPool
+
+
+class FakePool:
+    """
+    runs every job at once in the test process
+    """
+    def __init__(self):
+        self.events = []
+
+    def record_event(self, event, **details):
+        self.events.append(dict(event=event, **details))
+
+
+def finished(result=None, error=None):
+    future = concurrent.futures.Future()
+    if error is None:
+        future.set_result(result)
+    else:
+        future.set_exception(error)
+    return future
+
+
+def import_strategy():
+    raise ImportError('No module named strategies.Broken')
+
+
+class BrokenObjective:
+    """
+    fails to load in every worker, like an objective whose strategy doesn't import
+    """
+    def __reduce__(self):
+        return import_strategy, ()
+
+
+def test_run_jobs_resubmits_failed_and_retired_slots():
+    pool = FakePool()
+    results = {0: [WorkerError('Worker 1 died with exit code -9.'), 'recycle_after_trials', None], 1: [None]}
+    submitted = []
+
+    def submit_job(slot):
+        submitted.append(slot)
+        result = results[slot].pop(0)
+        return finished(error=result) if isinstance(result, BaseException) else finished(result)
+
+    _run_jobs(pool, submit_job, 2)
+
+    assert sorted(submitted) == [0, 0, 0, 1]
+    assert [event['event'] for event in pool.events] == ['job_failed', 'worker_recycled']
+
+
+def test_run_jobs_raises_once_a_slot_is_given_up():
+    pool = FakePool()
+    submitted = []
+
+    def submit_job(slot):
+        submitted.append(slot)
+        if slot == 0:
+            return finished(error=WorkerError('Traceback ...\nImportError: no strategy'))
+        return finished()
+
+    with pytest.raises(WorkerError, match='no strategy'):
+        _run_jobs(pool, submit_job, 2)
+
+    assert submitted.count(0) == _MAX_JOB_FAILURES
+    assert pool.events[-1] == {'event': 'slot_given_up', 'slot': 0}
+
+
+def test_optimize_raises_if_every_job_fails(tmp_path):
+    study = JoblibStudy(study_name='failing', storage=f'sqlite:///{tmp_path}/optuna.sqlite',
+                        sampler=optuna.samplers.RandomSampler(seed=0))
+    with WorkerPool(2) as pool:
+        with pytest.raises(WorkerError, match='strategies.Broken'):
+            study.optimize(BrokenObjective(), n_trials=20, n_jobs=2, pool=pool)
+    assert [event['event'] for event in study.user_attrs['resource_events']].count('slot_given_up') == 2
+    assert study.trials == []
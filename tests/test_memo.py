@@ -0,0 +1,79 @@
+import importlib.util
+import sys
+
+import pytest
+
+pytest.importorskip('jesse')
+
+from jesse_optuna import memo  # noqa: E402
+
+CFG = {'strategy_name': 'Cross', 'exchange': 'Binance', 'symbol': 'BTC-USDT', 'timeframe': '1h',
+       'starting_balance': 1000, 'fee': 0.001, 'futures_leverage': 1, 'futures_leverage_mode': 'cross',
+       'settlement_currency': 'USDT', 'warm_up_candles': 100, 'extra_routes': {}}
+
+
+@pytest.fixture
+def strategy_dir(tmp_path, monkeypatch):
+    strategy_dir = tmp_path / 'strategies' / 'Cross'
+    strategy_dir.mkdir(parents=True)
+    (strategy_dir / '__init__.py').write_text('class Cross:\n    pass\n')
+    (strategy_dir / 'signals.py').write_text('PERIOD = 10\n')
+
+    def get_strategy_class(name):
+        spec = importlib.util.spec_from_file_location(f'strategies.{name}', strategy_dir / '__init__.py')
+        module = importlib.util.module_from_spec(spec)
+        monkeypatch.setitem(sys.modules, spec.name, module)
+        spec.loader.exec_module(module)
+        return getattr(module, name)
+
+    monkeypatch.setattr(memo.jh, 'get_strategy_class', get_strategy_class)
+    monkeypatch.setattr(memo, '_get_jesse_version', lambda: '1.0.0')
+    monkeypatch.setattr(memo, '_strategy_hashes', {})
+    return strategy_dir
+
+
+@pytest.fixture
+def fingerprints(monkeypatch):
+    fingerprints = {'Binance-BTC-USDT': '100:1600000000000:12345.0'}
+    monkeypatch.setattr(memo, 'get_candles_fingerprint', lambda exchange, symbol, *args: fingerprints[
+        f'{exchange}-{symbol}'])
+    return fingerprints
+
+
+def get_key(hp=None):
+    memo._strategy_hashes.clear()
+    return memo.get_memo_key('2021-01-01', '2021-06-01', hp or {'period': 10}, CFG)
+
+
+def test_memo_key_is_stable(strategy_dir, fingerprints):
+    assert get_key() == get_key()
+    assert get_key({'period': 11}) != get_key()
+
+
+def test_memo_key_changes_with_any_file_of_the_strategy(strategy_dir, fingerprints):
+    key = get_key()
+    (strategy_dir / 'signals.py').write_text('PERIOD = 20\n')
+    assert get_key() != key
+
+    key = get_key()
+    (strategy_dir / 'weights.json').write_text('[1, 2]')
+    assert get_key() != key
+
+    key = get_key()
+    (strategy_dir / '__pycache__').mkdir()
+    (strategy_dir / '__pycache__' / 'signals.cpython-311.pyc').write_bytes(b'\0')
+    assert get_key() == key
+
+
+def test_memo_key_changes_with_the_candles(strategy_dir, fingerprints):
+    key = get_key()
+    fingerprints['Binance-BTC-USDT'] = '101:1600000060000:12346.0'
+    assert get_key() != key
+
+
+def test_memo_round_trip(tmp_path):
+    backtest_memo = memo.BacktestMemo(str(tmp_path / 'memo.sqlite'))
+    assert backtest_memo.get('key') is None
+    backtest_memo.put('key', {'total': 3, 'win_rate': 0.5})
+    assert backtest_memo.get('key') == {'total': 3, 'win_rate': 0.5}
+    backtest_memo.close()
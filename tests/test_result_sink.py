@@ -0,0 +1,79 @@
+import csv
+import multiprocessing
+
+import numpy as np
+import pytest
+
+from jesse_optuna.result_sink import (ParquetResultSink, ResultSink, compact_results, empty_backtest_data,
+                                      get_result_columns, read_results)
+
+HP_DICT = [{'name': 'period', 'type': int}, {'name': 'ratio', 'type': float}]
+
+
+def metrics(total):
+    return dict(empty_backtest_data, total=total, win_rate=np.float64(0.5), sharpe_ratio=float('nan'))
+
+
+def read_csv(path):
+    with open(path, newline='') as handle:
+        return list(csv.reader(handle, delimiter='\t'))
+
+
+def write_results(path, worker, count):
+    sink = ResultSink(path, get_result_columns(HP_DICT), buffer_size=7)
+    for i in range(count):
+        sink.write_result({'period': worker, 'ratio': i / 10}, i, metrics(i), metrics(i))
+    sink.close()
+
+
+def test_csv_sink_buffers_rows(tmp_path):
+    path = str(tmp_path / 'results.csv')
+    sink = ResultSink(path, get_result_columns(HP_DICT), buffer_size=2)
+    for i in range(3):
+        sink.write_result({'period': i, 'ratio': 0.5}, i * 2, metrics(i), None)
+    assert len(read_csv(path)) == 2
+
+    sink.close()
+    rows = read_csv(path)
+    assert [row[:3] for row in rows] == [['0', '0.5', '0'], ['1', '0.5', '2'], ['2', '0.5', '4']]
+    assert all(len(row) == len(get_result_columns(HP_DICT)) for row in rows)
+    assert all(value == '' for value in rows[0][3 + len(empty_backtest_data):])
+
+
+def test_csv_batches_of_concurrent_workers_never_interleave(tmp_path):
+    path = str(tmp_path / 'results.csv')
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=write_results, args=(path, worker, 50)) for worker in range(4)]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()
+
+    rows = read_csv(path)
+    assert len(rows) == 200
+    assert all(len(row) == len(get_result_columns(HP_DICT)) for row in rows)
+    assert sorted((int(row[0]), int(row[2])) for row in rows) == [(w, i) for w in range(4) for i in range(50)]
+
+
+def test_parquet_sink_round_trip(tmp_path):
+    pytest.importorskip('pyarrow')
+    import pyarrow.dataset as ds
+
+    path = str(tmp_path / 'results')
+    sink = ParquetResultSink(path, HP_DICT, 'BTC-USDT', buffer_size=2)
+    for i in range(5):
+        sink.write_result({'period': np.int64(i), 'ratio': i / 10}, i * 2, metrics(i), metrics(i), trial_number=i)
+    sink.close()
+    assert len(list((tmp_path / 'results' / 'symbol=BTC-USDT').glob('part-*.parquet'))) == 3
+
+    results = read_results(path, columns=['period', 'score', 'testing_sharpe_ratio'],
+                           filter=ds.field('score') >= 4)
+    assert sorted(results['period']) == [2, 3, 4]
+    assert results['testing_sharpe_ratio'].isna().all()
+
+    compact_results(path)
+    assert len(list((tmp_path / 'results' / 'symbol=BTC-USDT').glob('part-*.parquet'))) == 1
+    results = read_results(path)
+    assert sorted(results['trial_number']) == [0, 1, 2, 3, 4]
+    assert (results['training_win_rate'] == 0.5).all()
+    assert set(results['symbol']) == {'BTC-USDT'}